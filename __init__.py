@@ -12,13 +12,14 @@
 # FITNESS FOR A PARTICULAR PURPOSE.
 # See the GNU General Public License for more details.
 
-import gui
 import utility
 
 def main(templates=None):
     """ Main window """
+    import gui
     gui.Window(templates)
 
 def mini(templates):
     """ Shotcut mini window prefilled """
+    import gui
     gui.Fixer(templates, gui.MiniWindow)
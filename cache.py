@@ -0,0 +1,99 @@
+# Remember solutions between runs
+# Created By Jason Dixon. http://internetimagery.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is a labor of love, and therefore is distributed
+# in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# Solutions are stored per group and frame. Before a cached solution is used, it is
+# set on the attributes and the markers are checked to be where they were when it was
+# solved. So changes to the markers or the rig are caught, without tracking them.
+from __future__ import print_function
+import collections
+import os.path
+import json
+
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
+
+def get_path(snap_path):
+    """ Cache file sitting alongside a snap file """
+    return os.path.splitext(snap_path)[0] + ".snapcache"
+
+def fingerprint(grp):
+    """ Positions and rotations of every marker in the group """
+    return [float(d) for a in grp.markers for b in a for c in (b.get_position(), b.get_rotation()) for d in c]
+
+class Solution_Cache(object):
+    """
+    Solved values for each group and frame, kept least recently used first.
+    path (optional). File to load from and save to. Kept in memory only if not provided.
+    limit (optional). Most solutions to keep. Oldest are dropped first. 100000 default.
+    tolerance (optional). How far markers can wander and still use the cached solution. 1e-6 default.
+    """
+    def __init__(s, path=None, limit=100000, tolerance=1e-6):
+        s.path = path
+        s.limit = limit
+        s.tolerance = tolerance
+        s.hits = s.misses = 0
+        s.entries = collections.OrderedDict()
+        if path and os.path.isfile(path):
+            with open(path, "r") as f:
+                for key, vals, prints in json.load(f):
+                    s.entries[key] = (vals, prints)
+        s.trim()
+
+    def get(s, grp, frame):
+        """ Cached values for group on frame, if they still fit. Values are left set if so. """
+        key = "{}:{!r}".format(grp.key, float(frame))
+        entry = s.entries.get(key)
+        if entry is not None:
+            current = grp.get_values()
+            grp.set_values(entry[0])
+            prints = fingerprint(grp)
+            if len(entry[1]) == len(prints) and all(abs(a - b) <= s.tolerance for a, b in izip(entry[1], prints)):
+                s.entries[key] = s.entries.pop(key) # Most recently used
+                s.hits += 1
+                return entry[0]
+            grp.set_values(current)
+            del s.entries[key] # Inputs changed. No longer any use.
+        s.misses += 1
+        return None
+
+    def changed(s, grp, frame):
+        """ Check if the markers have moved since group was solved on frame. Using values already set. """
+        entry = s.entries.get("{}:{!r}".format(grp.key, float(frame)))
+        if entry is None:
+            return True
+        prints = fingerprint(grp)
+        return len(entry[1]) != len(prints) or any(abs(a - b) > s.tolerance for a, b in izip(entry[1], prints))
+
+    def add(s, grp, frame, vals):
+        """ Remember values for group on frame. Values should already be set. """
+        key = "{}:{!r}".format(grp.key, float(frame))
+        s.entries.pop(key, None)
+        s.entries[key] = (list(vals), fingerprint(grp))
+        s.trim()
+
+    def trim(s):
+        """ Drop least recently used solutions, down to the limit """
+        while len(s.entries) > s.limit:
+            s.entries.popitem(last=False)
+
+    def save(s):
+        """ Write cache out to its file """
+        if s.path:
+            with open(s.path, "w") as f:
+                json.dump([[a, b, c] for a, (b, c) in s.entries.items()], f)
+
+    def __len__(s):
+        return len(s.entries)
@@ -0,0 +1,82 @@
+# Simplify solved animation into fewer keys
+# Created By Jason Dixon. http://internetimagery.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is a labor of love, and therefore is distributed
+# in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# Keys are fit with cubic spans, the same as unweighted keys with fixed tangents.
+# Start with keys on the ends, then keep splitting whichever span strays furthest
+# from the solved values, until every span is within tolerance.
+from __future__ import division
+from element_base import hermite
+import element
+
+def get_slopes(times, values):
+    """ Slope of values at each time, from their neighbours """
+    if len(times) < 2:
+        return [0.0] * len(times)
+    slopes = [(values[1] - values[0]) / (times[1] - times[0])]
+    for i in range(1, len(times) - 1):
+        slopes.append((values[i+1] - values[i-1]) / (times[i+1] - times[i-1]))
+    slopes.append((values[-1] - values[-2]) / (times[-1] - times[-2]))
+    return slopes
+
+def fit(times, values, tolerance=1e-3, key_times=None):
+    """
+    Fit as few keys as possible to sorted times and values. Returns [(time, value, slope)]
+    tolerance (optional). Furthest the curve can stray from any value. 1e-3 default.
+    key_times (optional). Only place keys at these times (and the ends). Anywhere default.
+    """
+    slopes = get_slopes(times, values)
+    last = len(times) - 1
+    allowed = set(range(1, last)) if key_times is None else set(i for i, a in enumerate(times) if a in key_times)
+    keys = set([0, last])
+    spans = [(0, last)] if last > 0 else []
+    while spans:
+        a, b = spans.pop()
+        errors = [(abs(hermite(times[i], times[a], values[a], slopes[a], times[b], values[b], slopes[b]) - values[i]), i)
+            for i in range(a + 1, b)]
+        if not errors:
+            continue
+        error, worst = max(errors)
+        candidates = [i for i in range(a + 1, b) if i in allowed]
+        if error <= tolerance or not candidates:
+            continue
+        split = min(candidates, key=lambda x: abs(x - worst)) # Nearest we can get to the worst
+        keys.add(split)
+        spans += [(a, split), (split, b)]
+    return [(times[i], values[i], slopes[i]) for i in sorted(keys)]
+
+def get_runs(times, step):
+    """ Split sorted times wherever they are further than step apart """
+    runs = [times[:1]]
+    for a, b in zip(times, times[1:]):
+        if b - a > step * 1.5:
+            runs.append([])
+        runs[-1].append(b)
+    return runs
+
+def reduce_keys(sink, tolerance=1e-3, key_times=None, step=None):
+    """
+    Fit keys collected in a Key_Sink into fewer keys. Returns a new Key_Sink, replacing keys over the same range.
+    tolerance (optional). Furthest the curve can stray from any key. 1e-3 default.
+    key_times (optional). {plug name: [time]} Only place keys at these times (and the ends). Anywhere default.
+    step (optional). Keys further than this apart are fit as separate runs, leaving keys between alone. None (one run) default.
+    """
+    reduced = element.Key_Sink()
+    for attr, keys in sink.keys.items():
+        times = sorted(keys)
+        allowed = None if key_times is None else set(key_times.get(str(attr), ()))
+        for run in ([times] if step is None else get_runs(times, step)):
+            for time, value, slope in fit(run, [keys[a] for a in run], tolerance, allowed):
+                reduced.add(attr, time, value, slope)
+            reduced.replace(attr, run[0], run[-1])
+    return reduced
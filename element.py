@@ -15,4 +15,7 @@
 try:
     from element_maya import *
 except ImportError:
-    raise RuntimeError("Element not supported")
+    try:
+        from element_headless import *
+    except ImportError:
+        raise RuntimeError("Element not supported")
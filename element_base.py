@@ -12,6 +12,30 @@
 # FITNESS FOR A PARTICULAR PURPOSE.
 # See the GNU General Public License for more details.
 
+from __future__ import division
+import collections
+
+def hermite(time, t1, v1, s1, t2, v2, s2):
+    """ Value at time on a cubic span between two keys, with slopes s1 and s2 """
+    span = t2 - t1
+    x = (time - t1) / span
+    x2 = x * x
+    x3 = x2 * x
+    return ((2*x3 - 3*x2 + 1) * v1 + (x3 - 2*x2 + x) * span * s1
+        + (3*x2 - 2*x3) * v2 + (x3 - x2) * span * s2)
+
+# Backends may also provide a function "evaluate_batch(group, batch)" returning
+# a list of groups.Snapshot, one per candidate in batch. Used to evaluate many
+# candidates in one pass. groups.Group falls back to one at a time without it.
+
+# Backends provide "get_marker(name)", returning a marker for an object or for mesh
+# components such as "mesh.vtx[1:5]". Markers have get_matrix, get_position and get_rotation.
+
+# Backends provide these functions, used to cache markers between changes:
+#   get_node_id(name). Identify the node behind a name, marker or attribute.
+#   get_upstream(name). Set of node ids that could move a marker.
+#   get_state(). Anything that changes whenever markers could move, other than by setting attributes.
+
 class Attribute(object):
     """ An Attribute """
     def set_value(s, val):
@@ -26,6 +50,23 @@ class Attribute(object):
         """ Keyframe value at current time """
         raise NotImplementedError
 
+    def get_key_times(s):
+        """ Times of keyframes already on the attribute """
+        raise NotImplementedError
+
+class Context(object):
+    """ Evaluate attributes and markers at a time, without changing the current frame.
+        Use as a context manager. ie: with Context(10): ...
+    """
+    def __init__(s, time):
+        s.time = time
+
+    def __enter__(s):
+        raise NotImplementedError
+
+    def __exit__(s, *_):
+        raise NotImplementedError
+
 class Marker_Set(object):
     """ Collection of two markers """
     def get_pos_distance(s):
@@ -36,6 +77,52 @@ class Marker_Set(object):
         """ Get rotational distance """
         raise NotImplementedError
 
+    def get_pos_residual(s):
+        """ Get positional offset (x, y, z) from first marker to second """
+        raise NotImplementedError
+
+    def get_rot_residual(s):
+        """ Get quaternion difference (x, y, z, w) from first marker to second """
+        raise NotImplementedError
+
+    def get_pose_distance(s, weight=1.0):
+        """ Get length of pose residual """
+        raise NotImplementedError
+
+    def get_pose_residual(s, weight=1.0):
+        """ Get positional offset and weighted quaternion difference (x, y, z, qx, qy, qz, qw), from one matrix per marker """
+        raise NotImplementedError
+
     def __iter__(s):
         """ Loop over entries """
         raise NotImplementedError
+
+class Key_Sink(object):
+    """ Collect keyframes, to write them all at once """
+    def __init__(s):
+        s.keys = collections.OrderedDict() # {attribute: {time: value}}
+        s.tangents = {} # {attribute: {time: slope}} Keys without are left to the host.
+        s.spans = {} # {attribute: [(start, end)]} Existing keys between are removed.
+        s.plugs = {} # {plug name: attribute} Groups sharing an attribute share its keys.
+
+    def get_attribute(s, attribute):
+        """ Attribute keys for the same plug are collected under """
+        return s.plugs.setdefault(str(attribute), attribute)
+
+    def add(s, attribute, time, value, tangent=None):
+        """ Collect a keyframe for later. Tangent is the slope, in value per frame. The latest on a time wins. """
+        attribute = s.get_attribute(attribute)
+        s.keys.setdefault(attribute, {})[time] = value
+        if tangent is not None:
+            s.tangents.setdefault(attribute, {})[time] = tangent
+
+    def replace(s, attribute, start, end):
+        """ Replace existing keys from start to end, rather than adding to them """
+        s.spans.setdefault(s.get_attribute(attribute), []).append((start, end))
+
+    def flush(s):
+        """ Write collected keyframes, and empty the sink """
+        raise NotImplementedError
+
+    def __len__(s):
+        return sum(len(a) for a in s.keys.values())
@@ -0,0 +1,522 @@
+# Abstracted Headless Elements. No host application required.
+# Created By Jason Dixon. http://internetimagery.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is a labor of love, and therefore is distributed
+# in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# Minimal in memory scene. Transforms with parenting, translate / rotate / scale
+# and keyframed attributes across a time axis. Matrices follow maya conventions
+# (row vectors, translation in the last row, rotate order xyz).
+from __future__ import print_function, division
+from element_base import hermite
+import element_base as base
+import collections
+import bisect
+import math
+import re
+
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
+
+ALIASES = {
+    "translateX": "tx", "translateY": "ty", "translateZ": "tz",
+    "rotateX": "rx", "rotateY": "ry", "rotateZ": "rz",
+    "scaleX": "sx", "scaleY": "sy", "scaleZ": "sz"}
+DEFAULTS = {
+    "tx": 0.0, "ty": 0.0, "tz": 0.0,
+    "rx": 0.0, "ry": 0.0, "rz": 0.0,
+    "sx": 1.0, "sy": 1.0, "sz": 1.0}
+COMPONENT = re.compile(r"^([^\.]+)\.(vtx|e|f)\[(\d+)(?::(\d+))?\]$") # "mesh.vtx[1:5]"
+IDENTITY = (1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+
+def sqrt(val):
+    return val and (val ** -0.5)*val
+
+def mult_matrix(m1, m2):
+    """ Multiply two 4x4 matrices """
+    return tuple(sum(m1[r*4+i] * m2[i*4+c] for i in range(4)) for r in range(4) for c in range(4))
+
+def compose_matrix(t, r, s):
+    """ Build local matrix from translate, rotate (degrees) and scale """
+    cx, cy, cz = (math.cos(math.radians(a)) for a in r)
+    sx, sy, sz = (math.sin(math.radians(a)) for a in r)
+    rot = ( # Rx * Ry * Rz
+        cy*cz, cy*sz, -sy,
+        sx*sy*cz - cx*sz, sx*sy*sz + cx*cz, sx*cy,
+        cx*sy*cz + sx*sz, cx*sy*sz - sx*cz, cx*cy)
+    return (
+        rot[0]*s[0], rot[1]*s[0], rot[2]*s[0], 0.0,
+        rot[3]*s[1], rot[4]*s[1], rot[5]*s[1], 0.0,
+        rot[6]*s[2], rot[7]*s[2], rot[8]*s[2], 0.0,
+        t[0], t[1], t[2], 1.0)
+
+def inverse_matrix(m):
+    """ Invert an affine 4x4 matrix """
+    a, b, c, d, e, f, g, h, i = m[0], m[1], m[2], m[4], m[5], m[6], m[8], m[9], m[10]
+    det = a*(e*i - f*h) - b*(d*i - f*g) + c*(d*h - e*g)
+    if not det:
+        raise RuntimeError("Matrix cannot be inverted.")
+    inv = [
+        (e*i - f*h) / det, (c*h - b*i) / det, (b*f - c*e) / det,
+        (f*g - d*i) / det, (a*i - c*g) / det, (c*d - a*f) / det,
+        (d*h - e*g) / det, (b*g - a*h) / det, (a*e - b*d) / det]
+    t = [-sum(m[12+k] * inv[k*3+j] for k in range(3)) for j in range(3)]
+    return (
+        inv[0], inv[1], inv[2], 0.0,
+        inv[3], inv[4], inv[5], 0.0,
+        inv[6], inv[7], inv[8], 0.0,
+        t[0], t[1], t[2], 1.0)
+
+def normalized_rows(m):
+    """ Strip scale from rotation part of matrix. Return 3x3 """
+    rows = []
+    for r in range(3):
+        row = m[r*4:r*4+3]
+        length = sqrt(sum(a*a for a in row)) or 1.0
+        rows.append([a / length for a in row])
+    return rows
+
+def decompose_rotation(m):
+    """ Euler rotation (degrees, xyz) from matrix """
+    r = normalized_rows(m)
+    cy = sqrt(r[0][0]*r[0][0] + r[0][1]*r[0][1])
+    if cy > 1e-10:
+        x = math.atan2(r[1][2], r[2][2])
+        y = math.atan2(-r[0][2], cy)
+        z = math.atan2(r[0][1], r[0][0])
+    else: # Gimbal lock
+        x = math.atan2(-r[2][1], r[1][1])
+        y = math.atan2(-r[0][2], cy)
+        z = 0.0
+    return tuple(math.degrees(a) for a in (x, y, z))
+
+def matrix_to_quat(m):
+    """ Quaternion (x, y, z, w) from rotation part of matrix """
+    r = normalized_rows(m)
+    trace = r[0][0] + r[1][1] + r[2][2]
+    if trace > 0:
+        w = sqrt(1.0 + trace) * 2
+        return ((r[1][2] - r[2][1]) / w, (r[2][0] - r[0][2]) / w, (r[0][1] - r[1][0]) / w, 0.25 * w)
+    if r[0][0] > r[1][1] and r[0][0] > r[2][2]:
+        x = sqrt(1.0 + r[0][0] - r[1][1] - r[2][2]) * 2
+        return (0.25 * x, (r[1][0] + r[0][1]) / x, (r[2][0] + r[0][2]) / x, (r[1][2] - r[2][1]) / x)
+    if r[1][1] > r[2][2]:
+        y = sqrt(1.0 + r[1][1] - r[0][0] - r[2][2]) * 2
+        return ((r[1][0] + r[0][1]) / y, 0.25 * y, (r[2][1] + r[1][2]) / y, (r[2][0] - r[0][2]) / y)
+    z = sqrt(1.0 + r[2][2] - r[0][0] - r[1][1]) * 2
+    return ((r[2][0] + r[0][2]) / z, (r[2][1] + r[1][2]) / z, 0.25 * z, (r[0][1] - r[1][0]) / z)
+
+class Curve(object):
+    """ Keyframes on an attribute. Linear interpolation, unless keys have tangents. Flat beyond the ends. """
+    def __init__(s):
+        s.times = []
+        s.values = []
+        s.tangents = [] # Slope of each key. None for linear.
+
+    def __len__(s):
+        return len(s.times)
+
+    def add(s, time, value, tangent=None):
+        """ Add or replace a key """
+        i = bisect.bisect_left(s.times, time)
+        if i < len(s.times) and s.times[i] == time:
+            s.values[i] = value
+            s.tangents[i] = tangent
+        else:
+            s.times.insert(i, time)
+            s.values.insert(i, value)
+            s.tangents.insert(i, tangent)
+
+    def add_keys(s, keys, tangents=None):
+        """ Add or replace many keys {time: value} at once, with optional {time: slope} """
+        merged = dict(izip(s.times, izip(s.values, s.tangents)))
+        tangents = tangents or {}
+        merged.update((a, (b, tangents.get(a))) for a, b in keys.items())
+        s.times = sorted(merged)
+        s.values = [merged[a][0] for a in s.times]
+        s.tangents = [merged[a][1] for a in s.times]
+
+    def remove(s, start, end):
+        """ Remove keys from start to end """
+        keep = [i for i, a in enumerate(s.times) if a < start or a > end]
+        s.times = [s.times[i] for i in keep]
+        s.values = [s.values[i] for i in keep]
+        s.tangents = [s.tangents[i] for i in keep]
+
+    def evaluate(s, time):
+        """ Get value at time """
+        i = bisect.bisect_right(s.times, time)
+        if not i:
+            return s.values[0]
+        if i == len(s.times):
+            return s.values[-1]
+        t1, t2 = s.times[i-1], s.times[i]
+        v1, v2 = s.values[i-1], s.values[i]
+        s1, s2 = s.tangents[i-1], s.tangents[i]
+        if s1 is None and s2 is None:
+            return v1 + (v2 - v1) * (time - t1) / (t2 - t1)
+        linear = (v2 - v1) / (t2 - t1)
+        return hermite(time, t1, v1, linear if s1 is None else s1, t2, v2, linear if s2 is None else s2)
+
+class Transform(object):
+    """ Node in the scene heirarchy """
+    def __init__(s, scene, name, parent=None):
+        s.scene = scene
+        s.name = name
+        s.parent = parent
+        s.attrs = dict(DEFAULTS)
+        s.curves = {}
+        s.points = [] # Mesh vertices in local space
+        s.faces = [] # Vertex indices around each face
+
+    def __repr__(s):
+        return s.name
+
+    def get_attr(s, attr):
+        """ Value of attribute at current time """
+        override = s.scene.overrides.get((s.name, attr))
+        if override is not None:
+            return override
+        curve = s.curves.get(attr)
+        if curve:
+            return curve.evaluate(s.scene.eval_time)
+        return s.attrs[attr]
+
+    def set_attr(s, attr, val):
+        """ Set attribute. Animated attributes hold the value until time changes. """
+        if attr in s.curves:
+            s.scene.overrides[(s.name, attr)] = val
+        else:
+            s.attrs[attr] = val
+
+    def local_matrix(s):
+        get = s.get_attr
+        return compose_matrix(
+            (get("tx"), get("ty"), get("tz")),
+            (get("rx"), get("ry"), get("rz")),
+            (get("sx"), get("sy"), get("sz")))
+
+    def world_matrix(s):
+        matrix = s.local_matrix()
+        parent = s.parent
+        while parent is not None:
+            matrix = mult_matrix(matrix, parent.local_matrix())
+            parent = parent.parent
+        return matrix
+
+    def get_edges(s):
+        """ Vertex pairs for each edge, numbered in the order faces first use them """
+        edges = collections.OrderedDict()
+        for face in s.faces:
+            for a, b in izip(face, face[1:] + face[:1]):
+                edges.setdefault((min(a, b), max(a, b)), None)
+        return list(edges)
+
+class Scene(object):
+    """ Collection of transforms living along a time axis """
+    def __init__(s):
+        s.version = 0 # Changes whenever anything but a static attribute does
+        s.new()
+
+    def new(s):
+        """ Clear everything out """
+        s.version += 1
+        s.nodes = collections.OrderedDict() # Parents before children
+        s.overrides = {}
+        s.time = 0.0
+        s.contexts = [] # (time, overrides) of each evaluation context
+
+    @property
+    def eval_time(s):
+        """ Time things are evaluated at. Current time, unless within a context. """
+        return s.contexts[-1][0] if s.contexts else s.time
+
+    def create(s, name, parent=None, **attrs):
+        """ Create a new transform. Optionally parented, with initial attribute values """
+        if name in s.nodes:
+            raise RuntimeError("\"{}\" already exists.".format(name))
+        s.version += 1
+        node = s.nodes[name] = Transform(s, name, s.get(parent) if parent else None)
+        for attr, val in attrs.items():
+            node.attrs[ALIASES.get(attr, attr)] = float(val)
+        return node
+
+    def add_mesh(s, name, points, faces=None):
+        """ Give a transform mesh points [(x, y, z)] and faces [(vertex, ...)] """
+        node = s.get(name)
+        node.points = [tuple(float(b) for b in a) for a in points]
+        node.faces = [tuple(int(b) for b in a) for a in faces or ()]
+        s.version += 1
+
+    def add_attr(s, name, attr, value=0.0):
+        """ Add a custom attribute to a transform """
+        s.get(name).attrs[attr] = float(value)
+        s.version += 1
+
+    def exists(s, name):
+        return name in s.nodes
+
+    def get(s, name):
+        """ Get transform from name """
+        try:
+            return s.nodes[name]
+        except KeyError:
+            raise RuntimeError("\"{}\" does not exist.".format(name))
+
+    def set_key(s, name, attr, time, value):
+        """ Keyframe attribute at time """
+        attr = ALIASES.get(attr, attr)
+        node = s.get(name)
+        if attr not in node.attrs:
+            raise RuntimeError("\"{}\" does not exist.".format(attr))
+        node.curves.setdefault(attr, Curve()).add(float(time), float(value))
+        s.overrides.pop((name, attr), None)
+        s.version += 1
+
+    def set_keys(s, name, attr, keys, tangents=None):
+        """ Keyframe attribute at many times {time: value}, with optional slopes {time: slope} """
+        attr = ALIASES.get(attr, attr)
+        node = s.get(name)
+        if attr not in node.attrs:
+            raise RuntimeError("\"{}\" does not exist.".format(attr))
+        tangents = tangents and dict((float(a), float(b)) for a, b in tangents.items())
+        node.curves.setdefault(attr, Curve()).add_keys(dict((float(a), float(b)) for a, b in keys.items()), tangents)
+        s.overrides.pop((name, attr), None)
+        s.version += 1
+
+    def remove_keys(s, name, attr, start, end):
+        """ Remove keys on attribute from start to end """
+        curve = s.get(name).curves.get(ALIASES.get(attr, attr))
+        if curve is not None:
+            curve.remove(start, end)
+            s.version += 1
+
+    def dump(s):
+        """ Scene as plain data """
+        return {"time": s.time, "nodes": [{
+            "name": a.name,
+            "parent": a.parent and a.parent.name,
+            "attrs": a.attrs,
+            "points": a.points,
+            "faces": a.faces,
+            "curves": {b: [c.times, c.values, c.tangents] for b, c in a.curves.items()}}
+            for a in s.nodes.values()]}
+
+    def restore(s, data):
+        """ Replace scene with plain data, from dump """
+        s.new()
+        for node in data["nodes"]:
+            s.create(node["name"], node["parent"], **node["attrs"])
+            if node.get("points"):
+                s.add_mesh(node["name"], node["points"], node.get("faces"))
+            for attr, (times, values, tangents) in node["curves"].items():
+                s.set_keys(node["name"], attr, dict(izip(times, values)), dict((a, b) for a, b in izip(times, tangents) if b is not None))
+        s.time = data["time"]
+
+    def set_time(s, time):
+        """ Move to a new time. Unkeyed changes to animated attributes are lost. """
+        s.time = float(time)
+        s.overrides.clear()
+        s.version += 1
+
+SCENE = Scene()
+
+def get_marker(name):
+    """ Marker for an object, or a component range such as "mesh.vtx[1:5]" """
+    return Component_Marker(name) if COMPONENT.match(name) else Marker(name)
+
+def get_node_id(name):
+    """ Identify the node behind a name, marker or attribute """
+    return name.split(".", 1)[0]
+
+def get_upstream(name):
+    """ Nodes that could move a marker, through parenting """
+    nodes = set()
+    node = SCENE.get(get_node_id(name))
+    while node is not None:
+        nodes.add(node.name)
+        node = node.parent
+    return nodes
+
+def get_state():
+    """ Changes whenever markers could have moved, other than by setting attributes """
+    return SCENE.version
+
+class Attribute(base.Attribute):
+    """ An Attribute """
+    def __init__(s, **data):
+        obj = data.get("obj", "")
+        attr = data.get("attr", "")
+        min_ = data.get("min", -float("Inf"))
+        max_ = data.get("max", float("Inf"))
+        s.bias = data.get("bias", 1.0)
+        s.name = "{}.{}".format(obj, attr)
+        s.obj = obj
+        s.attr = ALIASES.get(attr, attr)
+        if not SCENE.exists(obj) or s.attr not in SCENE.get(obj).attrs:
+            raise RuntimeError("\"{}\" does not exist.".format(attr))
+        s._node = SCENE.get(obj)
+        s.min, s.max = min_, max_
+
+    def __repr__(s):
+        return s.name
+
+    def set_value(s, val):
+        """ Set attribute value """
+        if val < s.min or val > s.max:
+            raise RuntimeError("Attribute {} is out of bounds (value {}). Please adjust it, or consider changing the min/max for the attribute, and try match again.".format(s.name, val))
+        s._node.set_attr(s.attr, val)
+        return val
+
+    def get_value(s):
+        """ Get current value """
+        return s._node.get_attr(s.attr)
+
+    def get_bias(s):
+        """ Get bias value """
+        return s.bias
+
+    def key(s, value):
+        """ Keyframe value at current time """
+        s.set_value(value)
+        SCENE.set_key(s.obj, s.attr, SCENE.eval_time, value)
+
+    def get_key_times(s):
+        """ Times of keyframes already on the attribute """
+        curve = s._node.curves.get(s.attr)
+        return list(curve.times) if curve else []
+
+class Key_Sink(base.Key_Sink):
+    """ Collect keyframes, writing each attributes curve in one go """
+    def flush(s):
+        """ Write collected keyframes, and empty the sink """
+        for attr, keys in s.keys.items():
+            for start, end in s.spans.get(attr, ()):
+                SCENE.remove_keys(attr.obj, attr.attr, start, end)
+            SCENE.set_keys(attr.obj, attr.attr, keys, s.tangents.get(attr))
+        s.keys.clear()
+        s.tangents.clear()
+        s.spans.clear()
+        s.plugs.clear()
+
+class Context(base.Context):
+    """ Evaluate at a time, without changing the current frame.
+        Unkeyed changes to animated attributes are lost when leaving.
+    """
+    def __enter__(s):
+        SCENE.contexts.append((float(s.time), SCENE.overrides))
+        SCENE.overrides = {}
+        SCENE.version += 1
+        return s
+
+    def __exit__(s, *_):
+        _, SCENE.overrides = SCENE.contexts.pop()
+        SCENE.version += 1
+
+class Marker(object):
+    """ A headless object """
+    def __init__(s, name):
+        s.name = name
+        s.node = SCENE.get(name)
+    def __repr__(s):
+        return s.name
+    def get_matrix(s):
+        """ Get world matrix of object """
+        return s.node.world_matrix()
+    def get_position(s):
+        """ Get position of object """
+        return s.get_matrix()[12:15]
+    def get_rotation(s):
+        """ Get rotation of object """
+        return matrix_to_quat(s.get_matrix())
+
+class Component_Marker(object):
+    """ Center of some mesh vertices, edges or faces. Vertices are found once. """
+    def __init__(s, name):
+        s.name = name
+        obj, kind, start, end = COMPONENT.match(name).groups()
+        s.node = SCENE.get(obj)
+        ids = range(int(start), int(end if end is not None else start) + 1)
+        if kind == "vtx":
+            vertices = ids
+        elif kind == "e":
+            edges = s.node.get_edges()
+            vertices = (b for a in ids for b in edges[a])
+        else:
+            vertices = (b for a in ids for b in s.node.faces[a])
+        s.indices = sorted(set(vertices))
+        if not s.indices or s.indices[-1] >= len(s.node.points):
+            raise RuntimeError("\"{}\" does not exist.".format(name))
+    def __repr__(s):
+        return s.name
+    def get_matrix(s):
+        """ Get world matrix of object, moved to the center of the components """
+        points = s.node.points
+        num = len(s.indices)
+        x, y, z = (sum(a) / num for a in izip(*[points[a] for a in s.indices]))
+        matrix = s.node.world_matrix()
+        center = [x * matrix[a] + y * matrix[a + 4] + z * matrix[a + 8] + matrix[a + 12] for a in range(3)]
+        return matrix[:12] + tuple(center) + matrix[15:]
+    def get_position(s):
+        """ Get position of object """
+        return s.get_matrix()[12:15]
+    def get_rotation(s):
+        """ Get rotation of object """
+        return matrix_to_quat(s.get_matrix())
+
+class Marker_Set(base.Marker_Set):
+    """ Collection of two markers """
+    def __init__(s, node1, node2):
+        s.node1 = get_marker(node1)
+        s.node2 = get_marker(node2)
+
+    def get_pos_distance(s):
+        """ Get positional distance """
+        return sqrt(sum((a - b)**2 for a, b in izip(s.node2.get_position(), s.node1.get_position())))
+
+    def get_rot_distance(s, sum=sum, zip=zip):
+        """ Get rotational distance """
+        r1 = s.node1.get_rotation()
+        r2 = s.node2.get_rotation()
+
+        dot = sum(a*b for a,b in zip(r1,r2))
+        return 1 - dot * dot
+
+    def get_pos_residual(s):
+        """ Get positional offset (x, y, z) from first marker to second """
+        return tuple(b - a for a, b in izip(s.node1.get_position(), s.node2.get_position()))
+
+    def get_rot_residual(s, sum=sum, zip=zip):
+        """ Get quaternion difference (x, y, z, w) from first marker to second """
+        r1 = s.node1.get_rotation()
+        r2 = s.node2.get_rotation()
+        sign = -1 if sum(a*b for a,b in zip(r1,r2)) < 0 else 1 # q and -q are the same rotation
+        return tuple(b - a*sign for a, b in zip(r1, r2))
+
+    def get_pose_distance(s, weight=1.0):
+        """ Get length of pose residual """
+        return sqrt(sum(a*a for a in s.get_pose_residual(weight)))
+
+    def get_pose_residual(s, weight=1.0, sum=sum, zip=zip):
+        """ Get positional offset and weighted quaternion difference (x, y, z, qx, qy, qz, qw), from one matrix per marker """
+        m1 = s.node1.get_matrix()
+        m2 = s.node2.get_matrix()
+        p1, p2 = m1[12:15], m2[12:15]
+        r1, r2 = matrix_to_quat(m1), matrix_to_quat(m2)
+        sign = -1 if sum(a*b for a,b in zip(r1,r2)) < 0 else 1 # q and -q are the same rotation
+        return tuple(b - a for a, b in zip(p1, p2)) + tuple((b - a*sign) * weight for a, b in zip(r1, r2))
+
+    def __iter__(s):
+        """ Loop over entries """
+        yield s.node1
+        yield s.node2
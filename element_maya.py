@@ -16,8 +16,11 @@
 # Match positions / rotations.
 from __future__ import print_function, division
 import element_base as base
+import maya.api.OpenMayaAnim as oma
 import maya.api.OpenMaya as om
 import maya.cmds as cmds
+import undo_maya
+import math
 
 def get_node(name):
     """ Get Node """
@@ -32,6 +35,25 @@ def get_plug(obj, attr):
     attr = func.attribute(attr)
     return om.MPlug(node, attr)
 
+def get_node_id(name):
+    """ Identify the node behind a name, marker or attribute """
+    name = name.split(".", 1)[0]
+    return (cmds.ls(name, l=True) or [name])[0]
+
+def get_upstream(name):
+    """ Nodes that could move a marker, through parenting and connections """
+    parents = []
+    for path in cmds.ls(name.split(".", 1)[0], l=True):
+        parts = path.split("|")
+        parents += ["|".join(parts[:i]) for i in range(2, len(parts) + 1)]
+    return set(cmds.ls(parents + (cmds.listHistory(parents) or []), l=True))
+
+def get_state():
+    """ Changes whenever markers could have moved, other than by setting attributes """
+    if Context.current is not None:
+        return Context.current.time, Context.generation
+    return oma.MAnimControl.currentTime().value, Context.generation
+
 def sqrt(val):
     return val and (val ** -0.5)*val
 
@@ -93,43 +115,161 @@ class Attribute(base.Attribute):
     def key(s, value):
         """ Keyframe value at current time """
         s.set_value(value) # Can't use values directly, as some attributes work in radians
+        if Context.current is not None:
+            return cmds.setKeyframe(str(s), t=Context.current.time, v=value)
         cmds.setKeyframe(str(s))
 
+    def get_key_times(s):
+        """ Times of keyframes already on the attribute """
+        return cmds.keyframe(str(s), q=True, tc=True) or []
+
+class Key_Sink(base.Key_Sink):
+    """ Collect keyframes, writing each attributes curve in one go. Writes are undoable. """
+    def flush(s):
+        """ Write collected keyframes, and empty the sink """
+        unit = om.MTime.uiUnit()
+        modifier = om.MDGModifier() # New curves
+        change = oma.MAnimCurveChange() # Keys
+        for attr, keys in s.keys.items():
+            curves = oma.MAnimUtil.findAnimation(attr._attr)
+            curve = oma.MFnAnimCurve(curves[0]) if curves else oma.MFnAnimCurve()
+            if not curves:
+                curve.create(attr._attr, modifier)
+                modifier.doIt()
+            spans = s.spans.get(attr)
+            if spans: # Clear out old keys, keeping those about to be replaced
+                for index in reversed(range(curve.numKeys)):
+                    time = curve.input(index).asUnits(unit)
+                    if time not in keys and any(start <= time <= end for start, end in spans):
+                        curve.remove(index, change)
+            times, values = om.MTimeArray(), om.MDoubleArray()
+            for time, value in sorted(keys.items()):
+                if attr._is_angle: # Curves work in radians
+                    value = math.radians(value)
+                mtime = om.MTime(time, unit)
+                index = curve.find(mtime)
+                if index is None:
+                    times.append(mtime)
+                    values.append(value)
+                else:
+                    curve.setValue(index, value, change)
+            if len(times):
+                curve.addKeys(times, values, oma.MFnAnimCurve.kTangentGlobal, oma.MFnAnimCurve.kTangentGlobal, True, change)
+            for time, slope in s.tangents.get(attr, {}).items():
+                index = curve.find(om.MTime(time, unit))
+                curve.setInTangentType(index, oma.MFnAnimCurve.kTangentFixed, change)
+                curve.setOutTangentType(index, oma.MFnAnimCurve.kTangentFixed, change)
+                for is_in in (True, False): # Direction in ui units (frames, degrees)
+                    curve.setTangent(index, 1.0, slope, is_in, change, True)
+        if s.keys:
+            undo_maya.register(modifier, change) # Part of any open undo chunk
+        s.keys.clear()
+        s.tangents.clear()
+        s.spans.clear()
+        s.plugs.clear()
+
+class Context(base.Context):
+    """ Evaluate at a time, without changing the current frame.
+        Only reads follow the context. Setting an animated attribute will not stick.
+    """
+    current = None
+    generation = 0 # Changes on entering or leaving any context
+    def __enter__(s):
+        s._prev, Context.current = Context.current, s
+        s._guard = om.MDGContextGuard(om.MDGContext(om.MTime(s.time, om.MTime.uiUnit())))
+        Context.generation += 1
+        return s
+
+    def __exit__(s, *_):
+        s._guard = None # Restores previous context
+        Context.current = s._prev
+        Context.generation += 1
+
 class Marker(object):
     """ A maya object """
     def __init__(s, name):
         s.name = name
         node = get_node(name)
         s.node = om.MFnTransform(om.MDagPath.getAPathTo(node))
+        s.matrix = s.node.findPlug("worldMatrix", False).elementByLogicalIndex(0)
     def __repr__(s):
         return s.name
         # return s.node.name()
+    def get_matrix(s):
+        """ Get world matrix through the DG, so it follows the evaluation context """
+        return om.MTransformationMatrix(om.MFnMatrixData(s.matrix.asMObject()).matrix())
     def get_position(s):
         """ Get position of object """
-        try:
-            return s.node.translation(om.MSpace.kWorld)
-        except RuntimeError:
-            pos = list(zip(*[iter(cmds.xform(s.name, q=True, t=True, ws=True))]*3))
-            pos_num = len(pos)
-            total = reduce(lambda x, y: (a+b for a,b in zip(x, y)) ,pos)
-            return om.MVector([a/pos_num for a in total])
+        if Context.current is not None:
+            return s.get_matrix().translation(om.MSpace.kWorld)
+        return s.node.translation(om.MSpace.kWorld)
     def get_rotation(s):
         """ Get rotation of object """
-        try:
-            return s.node.rotation(om.MSpace.kWorld, True)
-        except RuntimeError:
-            m = cmds.xform(s.name, q=True, ws=True, m=True)
-            qw = (sqrt(max(0, 1 + m[0] + m[5] + m[10])) * 0.5)
-            qx = (sqrt(max(0, 1 + m[0] - m[5] - m[10])) * 0.5) * (1 if m[6] - m[9] > 0 else -1)
-            qy = (sqrt(max(0, 1 - m[0] + m[5] - m[10])) * 0.5) * (1 if m[8] - m[2] > 0 else -1)
-            qz = (sqrt(max(0, 1 - m[0] - m[5] + m[10])) * 0.5) * (1 if m[1] - m[4] > 0 else -1)
-            return qx, qy, qz, qw
+        if Context.current is not None:
+            return s.get_matrix().rotation(True)
+        return s.node.rotation(om.MSpace.kWorld, True)
+
+class Component_Marker(object):
+    """ Center of some mesh vertices, edges or faces. Vertices are found once.
+        Points are read one at a time if there are few, else the whole mesh is read in one go.
+    """
+    bulk_ratio = 0.1 # Portion of the mesh selected, before reading the whole thing is quicker
+    def __init__(s, name):
+        s.name = name
+        sel = om.MSelectionList()
+        for vertices in cmds.polyListComponentConversion(name, tv=True) or []:
+            sel.add(vertices)
+        if not sel.length():
+            raise RuntimeError("\"{}\" is not a mesh component.".format(name))
+        shape = sel.getComponent(0)[0].extendToShape()
+        s.indices = sorted(set(b for a in range(sel.length())
+            for b in om.MFnSingleIndexedComponent(sel.getComponent(a)[1]).getElements()))
+        s.mesh = om.MFnMesh(shape)
+        s.bulk = len(s.indices) > s.mesh.numVertices * s.bulk_ratio
+        s.points = om.MFnDependencyNode(shape.node()).findPlug("worldMesh", False).elementByLogicalIndex(shape.instanceNumber())
+        transform = om.MDagPath(shape)
+        transform.pop()
+        s.node = om.MFnTransform(transform)
+        s.matrix = s.node.findPlug("worldMatrix", False).elementByLogicalIndex(transform.instanceNumber())
+    def __repr__(s):
+        return s.name
+    def get_position(s):
+        """ Get center of components """
+        if Context.current is not None: # Evaluate mesh through the DG, so it follows the evaluation context
+            mesh, space = om.MFnMesh(s.points.asMObject()), om.MSpace.kObject # World mesh is already in world space
+        else:
+            mesh, space = s.mesh, om.MSpace.kWorld
+        center = om.MVector()
+        if s.bulk:
+            points = mesh.getPoints(space)
+            for i in s.indices:
+                center += om.MVector(points[i])
+        else:
+            for i in s.indices:
+                center += om.MVector(mesh.getPoint(i, space))
+        return center / len(s.indices)
+    def get_matrix(s):
+        """ Get world matrix of object, moved to the center of the components """
+        if Context.current is not None:
+            matrix = om.MTransformationMatrix(om.MFnMatrixData(s.matrix.asMObject()).matrix())
+        else:
+            matrix = om.MTransformationMatrix(s.node.dagPath().inclusiveMatrix())
+        return matrix.setTranslation(s.get_position(), om.MSpace.kWorld)
+    def get_rotation(s):
+        """ Get rotation of object """
+        if Context.current is not None:
+            return om.MTransformationMatrix(om.MFnMatrixData(s.matrix.asMObject()).matrix()).rotation(True)
+        return s.node.rotation(om.MSpace.kWorld, True)
+
+def get_marker(name):
+    """ Marker for an object, or components such as "mesh.vtx[1:5]" """
+    return Component_Marker(name) if "." in name else Marker(name)
 
 class Marker_Set(base.Marker_Set):
     """ Collection of two markers """
     def __init__(s, node1, node2):
-        s.node1 = Marker(node1)
-        s.node2 = Marker(node2)
+        s.node1 = get_marker(node1)
+        s.node2 = get_marker(node2)
 
     def get_pos_distance(s):
         """ Get positional distance """
@@ -143,6 +283,30 @@ class Marker_Set(base.Marker_Set):
         dot = sum(a*b for a,b in zip(r1,r2))
         return 1 - dot * dot
 
+    def get_pos_residual(s):
+        """ Get positional offset (x, y, z) from first marker to second """
+        return tuple(s.node2.get_position() - s.node1.get_position())
+
+    def get_rot_residual(s, sum=sum, zip=zip):
+        """ Get quaternion difference (x, y, z, w) from first marker to second """
+        r1 = s.node1.get_rotation()
+        r2 = s.node2.get_rotation()
+        sign = -1 if sum(a*b for a,b in zip(r1,r2)) < 0 else 1 # q and -q are the same rotation
+        return tuple(b - a*sign for a, b in zip(r1, r2))
+
+    def get_pose_distance(s, weight=1.0):
+        """ Get length of pose residual """
+        return sqrt(sum(a*a for a in s.get_pose_residual(weight)))
+
+    def get_pose_residual(s, weight=1.0, sum=sum, zip=zip):
+        """ Get positional offset and weighted quaternion difference (x, y, z, qx, qy, qz, qw), from one matrix per marker """
+        m1 = s.node1.get_matrix()
+        m2 = s.node2.get_matrix()
+        p1, p2 = m1.translation(om.MSpace.kWorld), m2.translation(om.MSpace.kWorld)
+        r1, r2 = m1.rotation(True), m2.rotation(True)
+        sign = -1 if sum(a*b for a,b in zip(r1,r2)) < 0 else 1 # q and -q are the same rotation
+        return tuple(b - a for a, b in zip(p1, p2)) + tuple((b - a*sign) * weight for a, b in zip(r1, r2))
+
     def __iter__(s):
         """ Loop over entries """
         yield s.node1
@@ -0,0 +1,55 @@
+# Follow matching as it happens
+# Created By Jason Dixon. http://internetimagery.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is a labor of love, and therefore is distributed
+# in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# match.match(..., events=sink) sends each event to sink as a dict. Any function will do.
+# Every event has "event" and "time" (seconds since matching started). Events are:
+#   start. matcher, groups, start_frame, end_frame
+#   step. frame, group, iteration, distance, cost, calls. For every step of a matcher.
+#   solved. frame, group, distance, cost, calls, cached.
+#   end. calls, frames, solved, memo_hits, memo_misses
+from __future__ import division
+import json
+import time
+
+clock = getattr(time, "perf_counter", time.time)
+
+class Throttle(object):
+    """ Pass values on to func at most "rate" times a second. Anything 1 or more is always passed on. """
+    def __init__(s, func, rate=10):
+        s.func = func
+        s.interval = 1 / rate
+        s.last = None
+
+    def __call__(s, value):
+        now = clock()
+        if value >= 1 or s.last is None or now - s.last >= s.interval:
+            s.last = now
+            s.func(value)
+
+class JSON_Lines(object):
+    """ Write each event to a file, as a line of json. Use as a context manager, or close when done. """
+    def __init__(s, file_path, append=False):
+        s.file = open(file_path, "a" if append else "w")
+
+    def __call__(s, event):
+        s.file.write(json.dumps(event) + "\n")
+
+    def close(s):
+        s.file.close()
+
+    def __enter__(s):
+        return s
+
+    def __exit__(s, *_):
+        s.close()
@@ -15,44 +15,119 @@
 from __future__ import print_function, division
 import collections
 import element
+import hashlib
+import random
 import json
 import math
 import sys
 
 try:
     from itertools import izip
-except NameError:
+except ImportError:
     izip = zip
 
 POSITION = 0
 ROTATION = 1
+POSE = 2 # Position and rotation together
+
+GRADIENT_FINITE = 0 # One probe per attribute
+GRADIENT_SPSA = 1 # Two probes, regardless of attribute count
 
 Snapshot = collections.namedtuple("Snapshot", ["dist", "vals", "cost"])
 
-def save(templates, file_path):
-    """ Export a list of groups into a file """
+# Ways of measuring distance, for each match type. Bound once when a group is made.
+#   measure(marker_set, pose_weight). Distance between a pair of markers.
+#   residual(length2). The same distance, from the squared length of the pair's residual.
+#   warp(dist). Cost the optimizers work with. Shapes the distance to improve convergeance.
+Metric = collections.namedtuple("Metric", ["measure", "residual", "warp"])
+METRICS = {POSITION: collections.OrderedDict(), ROTATION: collections.OrderedDict(), POSE: collections.OrderedDict()} # First is default
+RESIDUALS = {
+    POSITION: lambda markers, weight: markers.get_pos_residual(),
+    ROTATION: lambda markers, weight: markers.get_rot_residual(),
+    POSE: lambda markers, weight: markers.get_pose_residual(weight)}
+
+def add_metric(match_type, name, residual, warp=math.log, measure=None):
+    """ Register a metric. Distance is measured from residuals, unless a quicker measure is given. """
+    if measure is None:
+        get_residual = RESIDUALS[match_type]
+        measure = lambda markers, weight: residual(sum(a*a for a in get_residual(markers, weight)))
+    METRICS[match_type][name] = Metric(measure, residual, warp)
+
+def get_metric(match_type, name=None):
+    """ Get metric by name. Default for the match type if no name is given. """
+    if match_type not in METRICS:
+        raise RuntimeError("Distance type not supported.")
+    metrics = METRICS[match_type]
+    if name is None:
+        return next(iter(metrics.items()))
+    if name not in metrics:
+        raise RuntimeError("Metric \"{}\" not supported.".format(name))
+    return name, metrics[name]
+
+def log_rotation(dist, log=math.log, base=math.log(1.2)):
+    """ Log with a shallow base, for the small range of rotational distance """
+    return log(dist) / base
+
+def quat_angle(length2, acos=math.acos):
+    """ Angle between two quaternions, from the squared length of their difference """
+    return 2 * acos(max(-1.0, min(1.0, 1 - length2 * 0.5)))
+
+add_metric(POSITION, "linear", math.sqrt, measure=lambda markers, weight: markers.get_pos_distance())
+add_metric(POSITION, "squared", float, float, lambda markers, weight: markers.get_pos_distance() ** 2)
+add_metric(ROTATION, "aprox_angle", lambda x: 1 - (1 - x * 0.5) ** 2, log_rotation, lambda markers, weight: markers.get_rot_distance()) # |q2 - q1|^2 = 2 - 2 * dot
+add_metric(ROTATION, "angle", quat_angle)
+add_metric(ROTATION, "linear", math.sqrt, lambda x: 10 * math.log(x))
+add_metric(ROTATION, "custom", lambda x: 5 * x, float)
+add_metric(POSE, "linear", math.sqrt, measure=lambda markers, weight: markers.get_pose_distance(weight))
+add_metric(POSE, "squared", float, float)
+
+def dump(templates):
+    """ Turn a list of groups into plain data """
     data = []
     for template in templates:
         data.append({
             "enabled": template.enabled,
             "name": template.name,
             "match_type": template.match_type,
+            "gradient": template.gradient,
             "markers": template.markers,
-            "attributes": template.attributes})
+            "attributes": template.attributes,
+            "order": template.order,
+            "matcher": template.matcher,
+            "pose_weight": template.pose_weight,
+            "metric": template.metric})
+    return data
+
+def content_key(templates):
+    """ Hash of what the groups contain. Used to check cached information is still valid. """
+    data = [dict((a, b) for a, b in d.items() if a not in ("order", "matcher")) for d in dump(templates)]
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def restore(data):
+    """ Turn plain data back into a list of groups """
+    return [Template(**d) for d in data]
+
+def save(templates, file_path):
+    """ Export a list of groups into a file """
     with open(file_path, "w") as f:
-        json.dump(data, f, indent=4)
+        json.dump(dump(templates), f, indent=4)
 
 def load(file_path):
     """ Load a list of groups from a file """
     with open(file_path, "r") as f:
-        return [Template(**d) for d in json.load(f)]
+        return restore(json.load(f))
+
+STAMPS = collections.defaultdict(int) # {node: count} Bumped whenever an attribute on node is set
 
 class WrapAttr(element.Attribute):
     """ Attribute wrapper with caching, metrics and allowing out of bounds."""
     def __init__(s, *args, **kwargs):
         s._cache = None
         s._num_calls = 0
+        s._num_sets = 0 # Share of STAMPS from this attribute
         super(WrapAttr, s).__init__(*args, **kwargs)
+        s._node_id = element.get_node_id(str(s))
+        STAMPS[s._node_id] += 0 # Register node, so markers know to watch it
     def clear_cache(s):
         s._cache = None
     def get_value(s):
@@ -63,60 +138,147 @@ class WrapAttr(element.Attribute):
     def set_value(s, val):
         s._num_calls += 1
         s._cache = val
+        s._num_sets += 1
+        STAMPS[s._node_id] += 1
         super(WrapAttr, s).set_value(s.min if val < s.min else s.max if val > s.max else val)
     def get_calls(s):
         return s._num_calls
 
+class Cached_Marker(object):
+    """ Marker wrapper, reading from host only when something upstream could have moved it """
+    def __init__(s, marker):
+        s.marker = marker
+        s.name = marker.name
+        s.upstream = element.get_upstream(s.name) # Nodes that can move us
+        s.relevant = [] # Upstream nodes with attributes being set
+        s.watched = -1 # Size of STAMPS when relevant was collected
+        s.key = None
+        s.cache = {}
+        s.reads = 0
+    def __repr__(s):
+        return repr(s.marker)
+    def clear_cache(s):
+        s.cache.clear()
+    def get_key(s):
+        """ Changes whenever marker may have moved """
+        if s.watched != len(STAMPS):
+            s.watched = len(STAMPS)
+            s.relevant = [a for a in STAMPS if a in s.upstream]
+        return element.get_state(), sum(STAMPS[a] for a in s.relevant)
+    def get(s, name):
+        key = s.get_key()
+        if key != s.key:
+            s.key = key
+            s.cache.clear()
+        try:
+            return s.cache[name]
+        except KeyError:
+            s.reads += 1
+            value = s.cache[name] = getattr(s.marker, name)()
+            return value
+    def get_matrix(s):
+        return s.get("get_matrix")
+    def get_position(s):
+        return s.get("get_position")
+    def get_rotation(s):
+        return s.get("get_rotation")
+
 class WrapMarkerSet(element.Marker_Set):
-    """ Marker wrapper tracking calls to host """
+    """ Marker wrapper tracking calls to host. Markers are only read again if their upstream changes. """
     def __init__(s, *args, **kwargs):
-        s._num_calls = 0
         super(WrapMarkerSet, s).__init__(*args, **kwargs)
-    def get_pos_distance(s, *args, **kwargs):
-        s._num_calls += 1
-        return super(WrapMarkerSet, s).get_pos_distance(*args, **kwargs)
-    def get_rot_distance(s, *args, **kwargs):
-        s._num_calls += 1
-        return super(WrapMarkerSet, s).get_rot_distance(*args, **kwargs)
+        s.node1 = Cached_Marker(s.node1)
+        s.node2 = Cached_Marker(s.node2)
+    def clear_cache(s):
+        s.node1.clear_cache()
+        s.node2.clear_cache()
     def get_calls(s):
-        return s._num_calls
+        return s.node1.reads + s.node2.reads
 
 # Format:
     # name = "string"
     # enabled = True/False
-    # match_type = POSITION/ROTATION
+    # match_type = POSITION/ROTATION/POSE
+    # gradient = GRADIENT_FINITE/GRADIENT_SPSA
     # markers = [("string", "string")]
     # attributes = [{"obj": "string", "attr": "string", "min": int, "max": int}]
+    # order = {"key": content_key, "component": int} Cached position in match order.
+    # matcher = "string" Name of matcher chosen by match.optim_auto.
+    # pose_weight = float Distance counted the same as a unit of quaternion difference, for POSE.
+    # metric = "string" Name of metric in METRICS for the match type. Default if None.
 
 class Template(object):
     """ Hold information, for transfer """
-    def __init__(s, name="Group", enabled=True, match_type=POSITION, markers=None, attributes=None):
+    def __init__(s, name="Group", enabled=True, match_type=POSITION, gradient=GRADIENT_FINITE, markers=None, attributes=None, order=None, matcher=None, pose_weight=1.0, metric=None):
         s.name = name
         s.enabled = enabled
         s.match_type=match_type
+        s.gradient = gradient
         s.markers = markers or []
         s.attributes = attributes or []
+        s.order = order
+        s.matcher = matcher
+        s.pose_weight = pose_weight
+        s.metric = metric
 
 class Group(object):
     """ A group of objects and attributes for matching """
     def __init__(s, template):
         s.num_calls = 0 # Track number of calls to "get_distance"
         s.name = template.name
+        s.key = content_key([template]) # Identify what is being matched
         s.match_type = template.match_type
+        s.pose_weight = template.pose_weight
+        s.metric, (s.measure, s.residual, s.warp) = get_metric(s.match_type, template.metric)
+        s.gradient = template.gradient
+        s.matcher = template.matcher # Chosen by match.optim_auto
+        s.races = {} # {matcher: [(missed, calls)]} Used by match.optim_auto
+        s.init_memo()
         s.markers = [WrapMarkerSet(*a) for a in template.markers]
         s.attributes = [WrapAttr(**a) for a in template.attributes]
 
+    def init_memo(s, limit=1000, precision=1e-12):
+        """ Remember snapshots of values already evaluated, until markers could have moved some other way """
+        s.memo = collections.OrderedDict() # {quantized values: Snapshot} Least recently used first
+        s.memo_limit = limit
+        s.memo_precision = precision
+        s.memo_key = None
+        s.memo_watch = None # Nodes moving our markers
+        s.memo_own = None # Our attributes on those nodes
+        s.memo_hits = s.memo_misses = 0
+
     def clear_cache(s):
         """ Clear up cached data """
         for attr in s.attributes:
             attr.clear_cache()
+        for marker in s.markers:
+            marker.clear_cache()
+        s.memo.clear()
 
     def get_calls(s):
-        """ Return number of calls to host system """
+        """ Return number of calls to host system. Evaluations found in the memo (memo_hits) make none. """
         calls = sum(a.get_calls() for a in s.attributes)
         calls += sum(a.get_calls() for a in s.markers)
         return calls
 
+    def recall(s, vals):
+        """ Snapshot of values if already evaluated, else None. Clears memo if markers could have moved. """
+        if s.memo_watch is None:
+            s.memo_watch = list(set(c for b in s.markers for m in b for c in m.upstream))
+            s.memo_own = [a for a in s.attributes if a._node_id in s.memo_watch]
+        # Sets made by anything but our own attributes, even on the same nodes
+        key = element.get_state(), sum(STAMPS.get(a, 0) for a in s.memo_watch) - sum(a._num_sets for a in s.memo_own)
+        if key != s.memo_key:
+            s.memo_key = key
+            s.memo.clear()
+        quantized = tuple(int(round(a / s.memo_precision)) for a in vals)
+        snapshot = s.memo.pop(quantized, None)
+        if snapshot is None:
+            return None
+        s.memo_hits += 1
+        s.memo[quantized] = snapshot # Most recently used
+        return snapshot
+
     def get_name(s):
         """ Useful for debugging """
         return s.name
@@ -130,29 +292,62 @@ class Group(object):
         for attr, new_val in izip(s.attributes, vals):
             attr.set_value(new_val)
 
+    def evaluate_batch(s, batch):
+        """ Get snapshots for a list of candidate values. Values are left set to the last candidate. """
+        evaluate = getattr(element, "evaluate_batch", None)
+        if evaluate is not None: # Backend can evaluate everything in one pass
+            return evaluate(s, batch)
+        # Fallback. One at a time, only touching attributes that changed between candidates.
+        # Candidates already evaluated are taken from the memo, without being set.
+        snapshots = []
+        prev = None
+        for vals in batch:
+            snapshot = s.recall(vals)
+            if snapshot is None:
+                if prev is None:
+                    s.set_values(vals)
+                else:
+                    for attr, old_val, new_val in izip(s.attributes, prev, vals):
+                        if old_val != new_val:
+                            attr.set_value(new_val)
+                snapshot = s.get_snapshot()
+                prev = vals
+            snapshots.append(snapshot)
+        if batch and prev is not batch[-1]:
+            s.set_values(batch[-1])
+        return snapshots
+
     def get_distance(s):
-        """ Calculate linear distance between markers """
-        if s.match_type == POSITION:
-            return abs(sum(a.get_pos_distance() for a in s.markers) / len(s.markers))
-        elif s.match_type == ROTATION:
-            return abs(sum(a.get_rot_distance() for a in s.markers) / len(s.markers))
-        else:
-            raise RuntimeError("Distance type not supported.")
-
-    def cost_distance(s, dist, log=math.log):
+        """ Calculate distance between markers, using the groups metric """
+        measure, weight = s.measure, s.pose_weight
+        return abs(sum(measure(a, weight) for a in s.markers) / len(s.markers))
+
+    def get_residuals(s):
+        """ Get offset vectors between each pair of markers """
+        get_residual, weight = RESIDUALS[s.match_type], s.pose_weight
+        return [get_residual(a, weight) for a in s.markers]
+
+    def residual_distance(s, residuals):
+        """ Distance from residuals. Same as get_distance, without asking the host again. """
+        residual = s.residual
+        return abs(sum(residual(sum(b*b for b in a)) for a in residuals) / len(residuals))
+
+    def cost_distance(s, dist):
         """ Warp distance value to improve convergeance """
         # Increase distance cost if out of bounds.
         cost = sum(abs(b - c.min) if b < c.min else abs(b - c.max) if b > c.max else 0
             for b, c in izip((a.get_value() for a in s.attributes), s.attributes))
-        if s.match_type == ROTATION: # Adjust log for rotation
-            _log, log = log, lambda x: _log(x, 1.2)
-        cost += log(dist or sys.float_info.min)
+        cost += s.warp(dist or sys.float_info.min)
         return cost
 
-    def keyframe(s, values):
-        """ Set a bunch of keyframes for each attribute """
+    def keyframe(s, values, sink=None, frame=None):
+        """ Set a bunch of keyframes for each attribute. Collect them in sink at frame to write later, if provided. """
         for at, val in izip(s.attributes, s.bounds(values)):
-            at.key(val)
+            if sink is None:
+                at.key(val)
+            else:
+                at.set_value(val)
+                sink.add(at, frame, val)
 
     def shift(s, step=1e-3):
         """ Shift location a little. """
@@ -162,19 +357,36 @@ class Group(object):
                 val -= 2 * step
             attr.set_value(val)
 
-    def get_gradient(s, precision=1e-5):
-        """ Get gradient at current position. """
-        result = []
+    def get_gradient(s, precision=1e-5, gradient_type=None, samples=1):
+        """ Get gradient at current position. Gradient type defaults to the groups own. """
+        gradient_type = s.gradient if gradient_type is None else gradient_type
+        if gradient_type == GRADIENT_SPSA:
+            return s.get_spsa_gradient(precision, samples)
         dist = s.get_distance()
-        for attr in s.attributes:
-            value = attr.get_value()
-            new_val = value + precision
+        values = s.get_values()
+        probes = []
+        for i, attr in enumerate(s.attributes):
+            new_val = values[i] + precision
             if new_val > attr.max:
-                new_val = value - precision
-            attr.set_value(new_val)
-            new_dist = s.get_distance()
-            result.append((new_dist - dist) / precision)
-            dist = new_dist
+                new_val = values[i] - precision
+            probe = list(values)
+            probe[i] = new_val
+            probes.append(probe)
+        snapshots = s.evaluate_batch(probes)
+        return [(a.dist - dist) / (b[i] - values[i]) for i, (a, b) in enumerate(izip(snapshots, probes))]
+
+    # https://www.jhuapl.edu/spsa/
+    def get_spsa_gradient(s, precision=1e-5, samples=1):
+        """ Estimate gradient from two probes per sample, by moving all attributes at once. Average samples to reduce noise. """
+        values = s.get_values()
+        result = [0.0] * len(values)
+        for _ in range(samples):
+            delta = [random.choice((-precision, precision)) for _ in values]
+            forward, back = s.evaluate_batch([
+                [a + b for a, b in izip(values, delta)],
+                [a - b for a, b in izip(values, delta)]])
+            diff = (forward.dist - back.dist) / (2 * samples)
+            result = [a + diff / b for a, b in izip(result, delta)]
         return result
 
     def bounds(s, vals):
@@ -182,11 +394,19 @@ class Group(object):
         return (at.min if v < at.min else at.max if v > at.max else v for v, at in izip(vals, s.attributes))
 
     def get_snapshot(s, warp=math.log):
-        """ Get position and distance as snapshot """
+        """ Get position and distance as snapshot. Remembered until markers could have moved. """
+        vals = s.get_values()
+        snapshot = s.recall(vals)
+        if snapshot is not None:
+            return snapshot._replace(vals=vals)
+        s.memo_misses += 1
         dist = s.get_distance()
         cost = s.cost_distance(dist)
-        vals = s.get_values()
-        return Snapshot(dist=dist, cost=cost, vals=vals)
+        snapshot = Snapshot(dist=dist, cost=cost, vals=vals)
+        if len(s.memo) >= s.memo_limit:
+            s.memo.popitem(last=False)
+        s.memo[tuple(int(round(a / s.memo_precision)) for a in vals)] = snapshot
+        return snapshot
 
     def __len__(s):
         return len(s.attributes)
@@ -194,3 +414,45 @@ class Group(object):
     def __iter__(s):
         for at in s.attributes:
             yield at
+
+class Composite_Group(Group):
+    """ Several groups matched as one. For groups that move each others markers. """
+    def __init__(s, grps):
+        s.num_calls = 0
+        s.groups = grps
+        s.name = " + ".join(a.name for a in grps)
+        s.key = hashlib.sha1("".join(a.key for a in grps).encode("utf-8")).hexdigest()
+        match_types = set(a.match_type for a in grps)
+        s.match_type = match_types.pop() if len(match_types) == 1 else None # Mixed
+        s.pose_weight = grps[0].pose_weight
+        metrics = set(a.metric for a in grps)
+        s.metric = metrics.pop() if s.match_type is not None and len(metrics) == 1 else None # Mixed
+        s.warp = grps[0].warp if s.metric is not None else math.log
+        s.gradient = grps[0].gradient
+        matchers = set(a.matcher for a in grps)
+        s.matcher = matchers.pop() if len(matchers) == 1 else None # Chosen when matched jointly before
+        s.races = {}
+        s.init_memo()
+        s.markers = [b for a in grps for b in a.markers]
+        s.attributes = []
+        seen = set()
+        for attr in (b for a in grps for b in a):
+            if str(attr) not in seen: # Groups can share attributes
+                seen.add(str(attr))
+                s.attributes.append(attr)
+
+    def get_distance(s):
+        """ Combined distance of every group """
+        return sum(a.get_distance() for a in s.groups)
+
+    def get_residuals(s):
+        """ Get offset vectors between each pair of markers, for every group """
+        return [b for a in s.groups for b in a.get_residuals()]
+
+    def residual_distance(s, residuals):
+        """ Distance from residuals. Same as get_distance, without asking the host again. """
+        dist = 0
+        for grp in s.groups:
+            dist += grp.residual_distance(residuals[:len(grp.markers)])
+            residuals = residuals[len(grp.markers):]
+        return dist
@@ -45,6 +45,7 @@ CANCEL = "Cancel"
 options = collections.OrderedDict()
 options["Position"] = groups.POSITION
 options["Rotation"] = groups.ROTATION
+options["Pose"] = groups.POSE
 
 class Widget(object):
     """ Simple widget """
@@ -267,17 +268,25 @@ class Tab(object):
         s.layout = cmds.formLayout(p=tab_parent)
         # s.layout = cmds.columnLayout(adj=True, p=s.parent, bgc=(1,0,0))
         s.ready = False
+        s.gradient = template.gradient
+        s.order = template.order
+        s.matcher = template.matcher
+        s.pose_weight = template.pose_weight
+        s.metric = template.metric
 
         # Group stuff
-        row = cmds.rowLayout(nc=2, adj=1, p=s.layout)
+        row = cmds.rowLayout(nc=3, adj=1, p=s.layout)
         s.GUI_enable = cmds.checkBox(l="Enable", v=True, cc=s.enable,
         ann="Disabled groups will not be evaluated. Useful if you don't want to use a group, while not wanting to delete it.")
-        s.GUI_type = cmds.optionMenu(
-        ann="Matching type. Position: Moves objects closer together. Rotation: Orients objects closer together.")
+        s.GUI_type = cmds.optionMenu(cc=s.update_metrics,
+        ann="Matching type. Position: Moves objects closer together. Rotation: Orients objects closer together. Pose: Both at once.")
         for i, opt in enumerate(options):
             cmds.menuItem(l=opt)
             if template.match_type == options[opt]:
                 cmds.optionMenu(s.GUI_type, e=True, sl=i+1)
+        s.GUI_metric = cmds.optionMenu(cc=s.set_metric,
+        ann="Way of measuring distance. Some converge faster than others, depending on the match.")
+        s.update_metrics()
         scroll = cmds.scrollLayout(cr=True, p=s.layout)
         pane = cmds.paneLayout(configuration="vertical2", p=scroll)
         # pane = cmds.paneLayout(configuration="vertical2", p=s.layout)
@@ -320,9 +329,11 @@ class Tab(object):
         sel, = utility.get_selection(1)
         loc, = cmds.spaceLocator(n="Marker_%s_Locator" % sel)
         s.markers.add(sel, loc)
-        attr = "translate" if s.get_type() == groups.POSITION else "rotate"
-        for ax in "XYZ":
-            s.attributes.add_attribute("%s.%s%s" % (loc, attr, ax))
+        match_type = s.get_type()
+        attrs = ["translate"] if match_type == groups.POSITION else ["rotate"] if match_type == groups.ROTATION else ["translate", "rotate"]
+        for attr in attrs:
+            for ax in "XYZ":
+                s.attributes.add_attribute("%s.%s%s" % (loc, attr, ax))
         cmds.select(loc)
 
     def rename(s):
@@ -343,6 +354,21 @@ class Tab(object):
         typ = cmds.optionMenu(s.GUI_type, q=True, v=True)
         return options[typ]
 
+    def update_metrics(s, *_):
+        """ List metrics available to the match type """
+        for item in cmds.optionMenu(s.GUI_metric, q=True, ill=True) or []:
+            cmds.deleteUI(item)
+        names = list(groups.METRICS[s.get_type()])
+        if s.metric not in names:
+            s.metric = None # Default
+        for name in names:
+            cmds.menuItem(l=name, p=s.GUI_metric)
+        cmds.optionMenu(s.GUI_metric, e=True, sl=names.index(s.metric) + 1 if s.metric else 1)
+
+    def set_metric(s, name):
+        """ Use metric for matching """
+        s.metric = name
+
     def enable(s, state):
         """ Enable / disable """
         cmds.checkBox(s.GUI_enable, e=True, v=state)
@@ -379,6 +405,11 @@ class Tab(object):
             enabled=s.is_active(),
             name=name,
             match_type=match_type,
+            gradient=s.gradient,
+            order=s.order,
+            matcher=s.matcher,
+            pose_weight=s.pose_weight,
+            metric=s.metric,
             markers=markers,
             attributes=attributes)
 
@@ -514,9 +545,17 @@ class Window(object):
             ann="Use Adam Optimizer.")
         cmds.menuItem(l="Random", rb=False, c=functools.partial(s.set_matcher, match.optim_random),
             ann="Use Random Optimizer.")
+        cmds.menuItem(l="Levenberg Marquardt", rb=False, c=functools.partial(s.set_matcher, match.optim_levenberg_marquardt),
+            ann="Use Levenberg Marquardt Optimizer. Works on offsets of each marker rather than an average distance.")
+        cmds.menuItem(l="L-BFGS", rb=False, c=functools.partial(s.set_matcher, match.optim_lbfgs),
+            ann="Use L-BFGS Optimizer. Quasi newton steps that stay within attribute limits.")
+        cmds.menuItem(l="Auto", rb=False, c=functools.partial(s.set_matcher, match.optim_auto),
+            ann="Race the optimizers on the first frame, and use whichever gets there fastest. The choice is kept with each group.")
         cmds.menuItem(d=True)
         s._prepos = cmds.menuItem(l="Pre Position", cb=True,
             ann="Attempt to position objects using small one-off methods before snapping.")
+        s._joint = cmds.menuItem(l="Joint Cycles", cb=False,
+            ann="Match groups that move each others markers together, rather than taking turns.")
         cmds.menu(l="Help", hm=True)
         cmds.menuItem(l="Website", c=lambda *_: webbrowser.open("http://internetimagery.com/code/attributesnap"),
             ann="View tool homepage.")
@@ -648,7 +687,9 @@ class Window(object):
         if s.idle:
             s.idle = False
             prepos = cmds.menuItem(s._prepos, q=True, cb=True)
-            valid = [tab.export() for tab in s.tabs if tab.validate() and tab.is_active()]
+            joint = cmds.menuItem(s._joint, q=True, cb=True)
+            tabs = [tab for tab in s.tabs if tab.validate() and tab.is_active()]
+            valid = [tab.export() for tab in tabs]
             num_valid = len(valid)
             if not valid:
                 return
@@ -656,9 +697,14 @@ class Window(object):
                 return
 
             # Match this!
-            with utility.progress() as prog:
-                for progress in match.match(valid, *s.range.export(), matcher=s.matcher, prepos=prepos):
-                    prog(progress)
+            try:
+                with utility.progress() as prog:
+                    for progress in match.match(valid, *s.range.export(), matcher=s.matcher, prepos=prepos, joint=joint):
+                        prog(progress)
+            finally: # Keep the order and matchers worked out, so they are saved and reused
+                for tab, template in zip(tabs, valid):
+                    tab.order = template.order
+                    tab.matcher = template.matcher
         s.idle = True
 
 class Retarget(object):
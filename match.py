@@ -14,8 +14,12 @@
 
 from __future__ import print_function, division
 import collections
+import contextlib
 import itertools
 import element
+import cache as caching
+import curves
+import timing
 import utility
 import groups
 import random
@@ -31,68 +35,144 @@ except NameError:
 # Reference:
 # https://cs231n.github.io/neural-networks-3/#gradcheck
 
-def form_heirarchy(grps):
-    """ Sort groups into an efficient heirarchy """
+def get_children(grps, query=None):
+    """ Find which groups move the markers of others. Read from the scene rather than probing. {group: [children]} """
+    query = query or utility.get_influences
+    markers = {g: set(b.name for a in g.markers for b in a) for g in grps}
+    influences = query(
+        list(set(str(b) for a in grps for b in a)),
+        list(set(b for a in markers.values() for b in a)))
+    children = collections.defaultdict(list)
+    for grp1 in grps:
+        moved = set(b for a in grp1 for b in influences[str(a)])
+        children[grp1] = [a for a in grps if a is not grp1 and moved & markers[a]]
+    return children
+
+def probe_children(grps):
+    """ Find which groups move the markers of others, by nudging each one and watching. {group: [children]} """
     cache_dist = {g: g.get_distance() for g in grps} # Keep track of distance values
-    sorted_grp = list(grps) # Our list of groups in sorted order
-    child_grp = collections.defaultdict(list) # Groups with relation to their children
+    children = collections.defaultdict(list)
     precision_move = 0.0001
     precision_check = 0.000000001
-
-    # Check all groups
     for grp1 in grps:
+        original = grp1.get_values()
         grp1.shift(precision_move) # Move values slightly
         for grp2 in grps: # Check what happened because of this
-            dist = grp2.get_distance()
-            diff = abs(dist - cache_dist[grp2])
-            if diff > precision_check:
-                if grp2 is not grp1: # Don't add self as child of self
-                    child_grp[grp1].append(grp2)
-            cache_dist[grp2] = dist
-        if child_grp[grp1]: # We have some children to sort through
-            for i, child in enumerate(sorted_grp):
-                if child is grp1:
-                    break
-                if child in child_grp[grp1]: # Find earliest child and swap positions
-                    sorted_grp.remove(grp1)
-                    sorted_grp.insert(i, grp1)
+            if grp2 is not grp1: # Don't add self as child of self
+                if abs(grp2.get_distance() - cache_dist[grp2]) > precision_check:
+                    children[grp1].append(grp2)
+        grp1.set_values(original) # Put things back
+        for grp2 in grps:
+            grp2.clear_cache()
+    return children
+
+def strongly_connected(grps, children):
+    """ Split groups into strongly connected components (Tarjan). Components come out children first. """
+    index = {}
+    low = {}
+    stack = []
+    components = []
+
+    def visit(grp):
+        index[grp] = low[grp] = len(index)
+        stack.append(grp)
+        for child in children[grp]:
+            if child not in index:
+                visit(child)
+                low[grp] = min(low[grp], low[child])
+            elif child in stack:
+                low[grp] = min(low[grp], index[child])
+        if low[grp] == index[grp]:
+            component = []
+            while True:
+                member = stack.pop()
+                component.append(member)
+                if member is grp:
                     break
-    # Collect any cycles that have been dug up.
-    cycles = collections.defaultdict(list)
-    for parent in child_grp:
-        for child in child_grp[parent]:
-            if parent in child_grp[child]:
-                cycles[parent].append(child)
-
-    # If we have any cycles. Warn about them.
-    if cycles:
-        utility.warn("The following groups have cycle issues, and may not evaluate correctly:\n{}".format(", ".join(c.get_name() for c in cycles)))
-
-    # Throw in duplicates for cyclic groups to ensure they get evaluated in differing orders
-    new_sorted_grp = []
-    for i, grp in enumerate(sorted_grp):
-        new_sorted_grp.append(grp)
-        if i:
-            # Check if the two cyclic groups are side by side
-            # TODO: Add functionality for more than two cyclic pairs (ie triplets etc)
-            prev_grp = sorted_grp[i-1]
-            if grp in cycles and prev_grp in cycles[grp]:
-                new_sorted_grp.append(prev_grp)
-    return new_sorted_grp
+            components.append(component)
+
+    for grp in grps:
+        if grp not in index:
+            visit(grp)
+    return components
+
+def sort_components(grps, query=None):
+    """
+    Sort groups into strongly connected components. Components moving the markers of others come first.
+    query (optional). function(attributes, markers) -> {attribute: set(markers)}. Backend default.
+    Backends without a query fall back to probing the scene.
+    """
+    if query is None and not hasattr(utility, "get_influences"):
+        children = probe_children(grps)
+    else:
+        children = get_children(grps, query)
+
+    # Order components so parents come before children. Ties keep the order given.
+    position = {g: i for i, g in enumerate(grps)}
+    components = [sorted(a, key=lambda x: position[x]) for a in strongly_connected(grps, children)]
+    owner = {b: i for i, a in enumerate(components) for b in a}
+    parents = collections.defaultdict(set)
+    for i, component in enumerate(components):
+        for child in (c for a in component for c in children[a]):
+            if owner[child] != i:
+                parents[owner[child]].add(i)
+    ready = [i for i in xrange(len(components)) if not parents[i]]
+    sorted_components = []
+    while ready:
+        i = min(ready, key=lambda x: position[components[x][0]])
+        ready.remove(i)
+        sorted_components.append(components[i])
+        for j, component in enumerate(components):
+            if i in parents[j]:
+                parents[j].remove(i)
+                if not parents[j]:
+                    ready.append(j)
+    return sorted_components
+
+def expand_components(components, joint=False):
+    """ Turn sorted components into a match order. Cycles are matched as one group if joint, else repeatedly. """
+    cycles = [a for a in components if len(a) > 1]
+    if cycles and not joint: # If we have any cycles. Warn about them.
+        utility.warn("The following groups have cycle issues, and may not evaluate correctly:\n{}".format(", ".join(c.get_name() for a in cycles for c in a)))
+
+    sorted_grp = []
+    for component in components:
+        if len(component) > 1 and joint:
+            sorted_grp.append(groups.Composite_Group(component))
+        else: # Throw in duplicates for cyclic groups to ensure they get evaluated in differing orders
+            sorted_grp += component + component[:-1]
+    return sorted_grp
+
+def form_heirarchy(grps, query=None, joint=False):
+    """ Sort groups into an efficient heirarchy. Cycles are matched as one group if joint. """
+    return expand_components(sort_components(grps, query), joint)
+
+def match_order(templates, grps, joint=False):
+    """ Order groups for matching. Reuses the order cached in the templates while their content is unchanged. """
+    key = groups.content_key(templates)
+    if all(a.order and a.order.get("key") == key for a in templates):
+        components = collections.defaultdict(list)
+        for template, grp in izip(templates, grps):
+            components[template.order["component"]].append(grp)
+        components = [components[a] for a in sorted(components)]
+    else:
+        components = sort_components(grps)
+        owner = {b: i for i, a in enumerate(components) for b in a}
+        for template, grp in izip(templates, grps):
+            template.order = {"key": key, "component": owner[grp]}
+    return expand_components(components, joint)
 
 def optim_random(group, step=0.01, limit=10, threshold=1e-8):
     """ Optimize using random samples. """
     best = group.get_snapshot()
     num_attrs = len(group)
-    step_limit = num_attrs * limit
     yield best
     while True:
         prev_best = best
         # Look around at possible steps. Found a better one? Move over there and increase our confidence.
-        for _ in xrange(step_limit):
-            candidate = [a + step * random.uniform(-1.0, 1.0) for a in best.vals]
-            group.set_values(candidate)
-            candidate_snapshot = group.get_snapshot()
+        for _ in xrange(limit):
+            candidates = [[a + step * random.uniform(-1.0, 1.0) for a in best.vals] for _ in xrange(num_attrs)]
+            candidate_snapshot = min(group.evaluate_batch(candidates), key=lambda x: x.dist)
             if candidate_snapshot.dist < best.dist:
                 best = candidate_snapshot
                 step *= 2
@@ -119,11 +199,12 @@ def optim_nelder_mead(group, step=0.001, limit=500):
     for _ in xrange(1): # restart once to ensure we're good.
         # Build our shape
         simplex = simplex[:1]
+        batch = []
         for i in xrange(num_attrs):
             vals = list(simplex[0].vals[:])
             vals[i] += step
-            group.set_values(vals)
-            simplex.append(group.get_snapshot())
+            batch.append(vals)
+        simplex += group.evaluate_batch(batch)
         for _ in xrange(limit):
             # Sort recorded values. Keep track of best.
             simplex.sort(key=lambda x: x.cost)
@@ -147,8 +228,7 @@ def optim_nelder_mead(group, step=0.001, limit=500):
 
             # Reflection
             val_refl = [a + (a - b) for a, b in izip(center, simplex[-1].vals)]
-            group.set_values(val_refl)
-            refl = group.get_snapshot()
+            refl, = group.evaluate_batch([val_refl])
             if simplex[0].cost <= refl.cost < simplex[-2].cost:
                 del simplex[-1]
                 simplex.append(refl)
@@ -157,16 +237,14 @@ def optim_nelder_mead(group, step=0.001, limit=500):
             # Expansion
             if refl.cost < simplex[0].cost:
                 val_exp = [a + 2 * (a - b) for a, b in izip(center, simplex[-1].vals)]
-                group.set_values(val_exp)
-                exp = group.get_snapshot()
+                exp, = group.evaluate_batch([val_exp])
                 del simplex[-1]
                 simplex.append(exp if exp.cost < refl.cost else refl)
                 continue
 
             # Contraction
             val_cont = [a + -0.5 * (a - b) for a, b in izip(center, simplex[-1].vals)]
-            group.set_values(val_cont)
-            cont = group.get_snapshot()
+            cont, = group.evaluate_batch([val_cont])
             if cont.cost < simplex[-1].cost:
                 del simplex[-1]
                 simplex.append(cont)
@@ -174,24 +252,22 @@ def optim_nelder_mead(group, step=0.001, limit=500):
 
             # Reduction
             best = simplex[0].vals
-            new_simplex = []
-            for vals in simplex:
-                vals_redux = [b + 0.5 * (a - b) for a, b in izip(vals.vals, best)]
-                group.set_values(vals_redux)
-                new_simplex.append(group.get_snapshot())
-            simplex = new_simplex
+            batch = [[b + 0.5 * (a - b) for a, b in izip(vals.vals, best)] for vals in simplex[1:]]
+            simplex = simplex[:1] + group.evaluate_batch(batch)
 
     # Done!
     yield simplex[0]
 
 
 
-def optim_adam(group, rate=0.8, resistance=0.8, friction=0.9, tolerance=1e-6, limit=500, debug=False):
+def optim_adam(group, rate=0.8, resistance=0.8, friction=0.9, tolerance=1e-6, limit=500, gradient_type=None, samples=1, debug=False):
     """
     Match using gradient descent + momentum.
     rate = sample size of each step.
     friction = how much dampening do we get.
     limit = how many steps do we take before giving up?
+    gradient_type = groups.GRADIENT_FINITE / groups.GRADIENT_SPSA. Defaults to the groups setting.
+    samples = SPSA perturbations averaged per step. One more each overshoot, up to one per attribute.
     """
     # Validate some parameters
     limit = abs(int(limit))
@@ -219,6 +295,7 @@ def optim_adam(group, rate=0.8, resistance=0.8, friction=0.9, tolerance=1e-6, li
             friction *= 0.5
             velocity = [a*0.5 for a in velocity]
             momentum = [a*0.5 for a in momentum]
+            samples = min(samples + 1, max(samples, len(group))) # Noisy estimates? Average more.
         prev = current
 
         # Check if we are closer than ever before.
@@ -235,7 +312,7 @@ def optim_adam(group, rate=0.8, resistance=0.8, friction=0.9, tolerance=1e-6, li
             break
 
         # Check if we are sitting on a flat plateau.
-        gradient = group.get_gradient(rate*0.01)
+        gradient = group.get_gradient(rate*0.01, gradient_type, samples)
         if i:
             mag = sum(c*c for c in (a - b for a, b in izip(gradient, prev_gradient)))
             length = mag and (mag ** -0.5) * mag
@@ -254,6 +331,208 @@ def optim_adam(group, rate=0.8, resistance=0.8, friction=0.9, tolerance=1e-6, li
         print("Finished after {} steps".format(i))
     yield closest
 
+def solve_linear(matrix, vector):
+    """ Solve matrix * x = vector with gaussian elimination. Returns None if singular. """
+    size = len(vector)
+    rows = [list(a) + [b] for a, b in izip(matrix, vector)]
+    for i in xrange(size):
+        pivot = max(xrange(i, size), key=lambda x: abs(rows[x][i]))
+        if abs(rows[pivot][i]) < 1e-300:
+            return None
+        rows[i], rows[pivot] = rows[pivot], rows[i]
+        for j in xrange(i + 1, size):
+            scale = rows[j][i] / rows[i][i]
+            rows[j] = [a - scale * b for a, b in izip(rows[j], rows[i])]
+    result = [0.0] * size
+    for i in reversed(xrange(size)):
+        result[i] = (rows[i][size] - sum(rows[i][j] * result[j] for j in xrange(i + 1, size))) / rows[i][i]
+    return result
+
+# https://en.wikipedia.org/wiki/Levenberg%E2%80%93Marquardt_algorithm
+def optim_levenberg_marquardt(group, damping=1e-3, precision=1e-6, tolerance=1e-14, limit=100):
+    """
+    Match using least squares on the offsets between each pair of markers.
+    damping = starting blend between gauss-newton (small) and gradient descent (large).
+    precision = step used to measure the jacobian.
+    limit = how many steps do we take before giving up?
+    """
+    residuals = [b for a in group.get_residuals() for b in a]
+    error = sum(a*a for a in residuals)
+    closest = group.get_snapshot()
+    curr_values = list(closest.vals)
+
+    yield closest
+
+    for _ in xrange(limit):
+        if error < tolerance:
+            break
+
+        # Measure how each attribute moves the residuals. One column per attribute.
+        jacobian = []
+        for i, attr in enumerate(group):
+            step = precision * max(1.0, abs(curr_values[i]))
+            if curr_values[i] + step > attr.max:
+                step = -step
+            attr.set_value(curr_values[i] + step)
+            probe = (b for a in group.get_residuals() for b in a)
+            jacobian.append([(a - b) / step for a, b in izip(probe, residuals)])
+            attr.set_value(curr_values[i])
+        normal = [[sum(a*b for a, b in izip(c1, c2)) for c2 in jacobian] for c1 in jacobian]
+        gradient = [-sum(a*b for a, b in izip(c, residuals)) for c in jacobian]
+
+        # Search for an improving step, leaning towards gradient descent while failing.
+        while damping < 1e10:
+            damped = [[b + damping * (b or 1.0) if i == j else b for j, b in enumerate(a)] for i, a in enumerate(normal)]
+            delta = solve_linear(damped, gradient)
+            if delta is not None:
+                new_values = list(group.bounds(a + b for a, b in izip(curr_values, delta)))
+                group.set_values(new_values)
+                new_residuals = group.get_residuals()
+                new_error = sum(b*b for a in new_residuals for b in a)
+                if new_error < error:
+                    damping = max(damping * 0.1, 1e-12)
+                    break
+            damping *= 10
+        else:
+            break # Can't improve any further
+
+        step_size = sum(abs(a - b) for a, b in izip(new_values, curr_values))
+        curr_values, error = new_values, new_error
+        residuals = [b for a in new_residuals for b in a]
+        dist = group.residual_distance(new_residuals)
+        closest = groups.Snapshot(dist=dist, cost=group.cost_distance(dist), vals=tuple(curr_values))
+        yield closest
+        if step_size < precision * 1e-3:
+            break
+
+    yield closest
+
+# https://en.wikipedia.org/wiki/Limited-memory_BFGS
+def optim_lbfgs(group, memory=6, precision=1e-6, tolerance=1e-14, limit=200):
+    """
+    Match using quasi newton steps, staying within attribute min / max.
+    memory = how many previous steps are used to shape the next step.
+    precision = step used to measure the gradient.
+    limit = how many steps do we take before giving up?
+    """
+    # Square positional distance, so it is smooth around the goal.
+    power = 2 if group.match_type in (groups.POSITION, groups.POSE) else 1
+    lower = [a.min for a in group]
+    upper = [a.max for a in group]
+
+    closest = group.get_snapshot()
+    curr_values = list(group.bounds(closest.vals))
+    if curr_values != list(closest.vals):
+        closest, = group.evaluate_batch([curr_values])
+    error = closest.dist ** power
+    gradient = [a * power * closest.dist ** (power - 1) for a in group.get_gradient(precision)]
+    history = collections.deque(maxlen=memory)
+
+    yield closest
+
+    for _ in xrange(limit):
+        if error < tolerance:
+            break
+
+        # Attributes sitting on a limit, and pushing against it, stay put.
+        free = [not ((a <= l and g > 0) or (a >= u and g < 0)) for a, l, u, g in izip(curr_values, lower, upper, gradient)]
+        if not any(g for g, f in izip(gradient, free) if f):
+            break
+
+        # Two loop recursion. Approximate inverse hessian * gradient.
+        direction = [g if f else 0.0 for g, f in izip(gradient, free)]
+        alphas = []
+        for step, change, rho in reversed(history):
+            alpha = rho * sum(a*b for a, b, f in izip(step, direction, free) if f)
+            direction = [d - alpha * c if f else 0.0 for d, c, f in izip(direction, change, free)]
+            alphas.append(alpha)
+        if history:
+            step, change, _ = history[-1]
+            scale = sum(a*b for a, b in izip(step, change)) / sum(a*a for a in change)
+        else: # Guess a step that would reach the goal, were things linear.
+            scale = error / (sum(a*a for a in direction) or 1.0)
+        direction = [d * scale for d in direction]
+        for (step, change, rho), alpha in izip(history, reversed(alphas)):
+            beta = rho * sum(a*b for a, b, f in izip(change, direction, free) if f)
+            direction = [d + (alpha - beta) * a if f else 0.0 for d, a, f in izip(direction, step, free)]
+        direction = [-a for a in direction]
+        if sum(a*b for a, b in izip(direction, gradient)) >= 0: # Not heading downhill. Start fresh.
+            history.clear()
+            scale = error / (sum(g*g for g, f in izip(gradient, free) if f) or 1.0)
+            direction = [-g * scale if f else 0.0 for g, f in izip(gradient, free)]
+
+        # Backtracking line search, projecting each step back into range.
+        rate = 1.0
+        for _ in xrange(20):
+            new_values = list(group.bounds(a + b * rate for a, b in izip(curr_values, direction)))
+            new_snapshot, = group.evaluate_batch([new_values])
+            new_error = new_snapshot.dist ** power
+            if new_error <= error + 1e-4 * sum(g * (a - b) for g, a, b in izip(gradient, new_values, curr_values)):
+                break
+            rate *= 0.5
+        else:
+            break # Could not find a better position
+
+        new_gradient = [a * power * new_snapshot.dist ** (power - 1) for a in group.get_gradient(precision)]
+        step = [a - b for a, b in izip(new_values, curr_values)]
+        change = [a - b for a, b in izip(new_gradient, gradient)]
+        curvature = sum(a*b for a, b in izip(step, change))
+        if curvature > 1e-20: # Keep only steps that curve upwards
+            history.append((step, change, 1.0 / curvature))
+
+        curr_values, error, gradient = new_values, new_error, new_gradient
+        if new_snapshot.dist < closest.dist:
+            closest = new_snapshot
+            yield closest
+        if sum(abs(a) for a in step) < precision * 1e-3:
+            break
+
+    yield closest
+
+# Matchers optim_auto can choose from. Most likely to win first.
+MATCHERS = [optim_levenberg_marquardt, optim_lbfgs, optim_adam, optim_nelder_mead, optim_random]
+
+def get_matcher(name):
+    """ Get matcher from its name """
+    for matcher in MATCHERS + [optim_auto]:
+        if matcher.__name__ == name:
+            return matcher
+    raise RuntimeError("Matcher \"{}\" does not exist.".format(name))
+
+def optim_auto(group, budget=300, race=1, tolerance=1e-10):
+    """
+    Race every matcher in MATCHERS from the same start, and keep using whichever arrives in the fewest calls.
+    The choice is kept in group.matcher. match saves it back to the template, so later matches skip the race.
+    budget (optional). Most calls to give each matcher in a race. 300 default.
+    race (optional). Number of frames to race over before choosing. 1 default.
+    tolerance (optional). Distance counted as arriving. 1e-10 default.
+    """
+    if group.matcher is None:
+        start = group.get_values()
+        best = None
+        for matcher in MATCHERS:
+            group.set_values(start)
+            calls = group.get_calls()
+            result = None
+            for snapshot in matcher(group):
+                if result is None or snapshot.dist < result.dist:
+                    result = snapshot
+                if snapshot.dist < tolerance or group.get_calls() - calls > budget:
+                    break
+            group.races.setdefault(matcher.__name__, []).append((result.dist >= tolerance, group.get_calls() - calls))
+            if best is None or result.dist < best.dist:
+                best = result
+        group.set_values(best.vals)
+        if len(group.races[MATCHERS[0].__name__]) >= race: # Choose before yielding. Caller may stop once matched.
+            score = lambda x: tuple(sum(a) for a in izip(*group.races[x.__name__])) # (misses, calls)
+            group.matcher = min(MATCHERS, key=score).__name__
+            print("Chose %s for %s." % (group.matcher, group.name))
+        yield best
+        if group.matcher is None or best.dist < tolerance:
+            return # Keep racing next frame, or nothing left to do
+    for snapshot in get_matcher(group.matcher)(group):
+        yield snapshot
+
 def linear_jump(grp):
     """ Attempt a straight jump towards the goal. Assuming a linear 1:1 attribute:distance ratio.
         If we are closer, begin otimization from this point. Else return to where we were.
@@ -267,7 +546,130 @@ def linear_jump(grp):
     else: grp.set_values(old_snapshot.vals)
     return False
 
-def match(templates, start_frame=None, end_frame=None, sub_frame=1.0, matcher=optim_adam, prepos=True, match_tolerance=1e-10, **kwargs):
+@contextlib.contextmanager
+def at_frame(frame, in_place=False):
+    """ Move to frame. Or evaluate at frame without moving, if in_place. """
+    if in_place:
+        with element.Context(frame):
+            yield
+    else:
+        utility.set_frame(frame)
+        yield
+
+class Predictor(object):
+    """ Guess upcoming values from those already solved.
+        Constant, linear and quadratic guesses are kept. The one that has been most accurate so far is used.
+    """
+    def __init__(s, decay=0.5):
+        s.decay = decay
+        s.history = collections.deque(maxlen=3) # (frame, values)
+        s.errors = [0.0, 0.0, 0.0] # Running error for each order
+        s.tested = 0 # Orders that have had their guesses checked
+
+    def guess(s, order, frame):
+        """ Extrapolate values to frame, using polynomial of order """
+        points = list(s.history)[-order-1:]
+        result = [0.0] * len(points[-1][1])
+        for i, (f1, vals) in enumerate(points): # Lagrange
+            weight = 1.0
+            for j, (f2, _) in enumerate(points):
+                if i != j:
+                    weight *= (frame - f2) / (f1 - f2)
+            result = [a + b * weight for a, b in izip(result, vals)]
+        return result
+
+    def add(s, frame, values):
+        """ Record solved values, and how good each guess would have been. Values for the same frame replace the last. """
+        if s.history and s.history[-1][0] == frame: # Solved again, such as groups in a cycle
+            s.history.pop()
+        s.tested = len(s.history)
+        for order in xrange(s.tested):
+            error = sum(abs(a - b) for a, b in izip(s.guess(order, frame), values))
+            s.errors[order] = s.errors[order] * s.decay + error * (1 - s.decay)
+        s.history.append((frame, values))
+
+    def predict(s, frame):
+        """ Best guess of values at frame. None if nothing to go on yet. """
+        if not s.history:
+            return None
+        order = min(xrange(s.tested or 1), key=lambda x: s.errors[x])
+        return s.guess(order, frame)
+
+class Anytime(object):
+    """
+    Match the current frame within a deadline, then keep on improving while idle. For live use, such as scrubbing.
+    Groups are matched in order. Whatever the best found by the deadline is, it is applied.
+    matcher (optional). Optimizer to use. levenberg marquardt default.
+    deadline (optional). Seconds to spend on each call. 0.05 default.
+    match_tolerance (optional). Distance counted as matched. 1e-10 default.
+    Other arguments are passed to the matcher.
+    """
+    def __init__(s, templates, matcher=optim_levenberg_marquardt, deadline=0.05, match_tolerance=1e-10, **kwargs):
+        templates = [t for t in templates if t.enabled]
+        s.grps = match_order(templates, [groups.Group(t) for t in templates])
+        if not s.grps: raise RuntimeError("No templates provided.")
+        s.matcher = matcher
+        s.deadline = deadline
+        s.match_tolerance = match_tolerance
+        s.kwargs = kwargs
+        s.frame = None
+        s.steps = []
+        s.best = {}
+        s.handle = None
+
+    def solve(s, frame=None, deadline=None):
+        """ Start matching frame (current default). Returns True if everything was matched in time. """
+        s.frame = utility.get_frame() if frame is None else frame
+        if s.frame != utility.get_frame():
+            utility.set_frame(s.frame)
+        for grp in s.grps:
+            grp.clear_cache() # Values may have changed with the frame
+        s.steps = [(a, s.matcher(a, **s.kwargs)) for a in s.grps]
+        s.best = {}
+        return s.refine(deadline)
+
+    def refine(s, deadline=None):
+        """ Keep matching where we left off, until deadline. Starts over if the frame has changed. Returns True if done. """
+        if s.frame is None or s.frame != utility.get_frame():
+            return s.solve(None, deadline)
+        if not s.steps:
+            return True # Nothing left to do
+        end_time = time.time() + (s.deadline if deadline is None else deadline)
+        try:
+            while s.steps and time.time() < end_time:
+                grp, step = s.steps[0]
+                try:
+                    snapshot = next(step)
+                    if grp not in s.best or snapshot.dist < s.best[grp].dist:
+                        s.best[grp] = snapshot
+                    if snapshot.dist >= s.match_tolerance:
+                        continue
+                except StopIteration:
+                    pass
+                s.steps.pop(0) # Group is done. Children match from its best.
+                grp.set_values(s.best[grp].vals)
+        finally: # Always leave the best we have found
+            for grp, _ in s.steps:
+                if grp in s.best:
+                    grp.set_values(s.best[grp].vals)
+        return not s.steps
+
+    def get_distance(s):
+        """ Distance of the best found so far, across all groups """
+        return sum(a.dist for a in s.best.values())
+
+    def start(s):
+        """ Keep refining whenever the host is idle """
+        if s.handle is None:
+            s.handle = utility.add_idle(s.refine)
+
+    def stop(s):
+        """ Stop refining when idle """
+        if s.handle is not None:
+            utility.remove_idle(s.handle)
+            s.handle = None
+
+def match(templates, start_frame=None, end_frame=None, sub_frame=1.0, matcher=optim_adam, prepos=True, predict=True, adaptive=0, adaptive_tolerance=1e-3, key_chunk=100, key_sink=None, time_context=False, joint=False, cache=None, incremental=False, margin=2, reduce=0, reduce_keys=False, reduce_distance=None, budget=0, budget_time=0, events=None, match_tolerance=1e-10, **kwargs):
     """
     Match groups across frames.
     update. function run updating matching progress.
@@ -276,13 +678,50 @@ def match(templates, start_frame=None, end_frame=None, sub_frame=1.0, matcher=op
     sub_frame (optional). Steps to take. 1.0 default.
     matcher (optional). Optimizer to use. adam default.
     prepos (optional). Pre position with small one off attempts to snap the marker before resorting to optimizer. True default.
+    predict (optional). Start each frame from values extrapolated from previous frames, if they are closer. True default.
+    adaptive (optional). Solve only every "adaptive" steps, then split the gaps wherever the keyed curves drift
+        further than adaptive_tolerance from the markers. 0 (solve every step) default.
+    key_chunk (optional). Collect keys, writing them in bulk every "key_chunk" solved frames. 0 keys each frame as it goes. 100 default.
+    key_sink (optional). element.Key_Sink to collect keys in, rather than writing them. Left for the caller to flush.
+    time_context (optional). Evaluate each frame in place, without changing the current frame. Keys are held until the end.
+        Attributes being matched must not already be animated, as maya will not take new values on them out of context. Raises if they are. False default.
+    joint (optional). Match groups that move each others markers together as one group, rather than taking turns. False default.
+    cache (optional). cache.Solution_Cache, or path to one. Frames solved before, with nothing changed, are keyed without solving.
+    incremental (optional). Solve only frames whose markers have moved since they were cached, and "margin" steps either side.
+        Other frames keep their keys. Each run of frames starts from the keys before it. Needs a cache. False default.
+    reduce (optional). Fit solved values with fewer keys, straying no further than "reduce" from any of them. 0 (key every step) default.
+        Each run of solved steps is fit on its own, leaving keys between runs alone.
+        reduce_keys. Only place keys where the attributes already had them. False default.
+        reduce_distance. Put back keys on any step where markers end up this much further apart than when solved. None default.
+    budget (optional). Most calls to the host per frame. Matchers for every group take turns, with the most improving going first.
+        Each group is keyed at the best it reached when the budget runs out. 0 (unlimited, one group at a time) default.
+    budget_time (optional). As with budget, but in seconds. 0 default.
+    events (optional). function(event) taking a dict for each step of matching. See events.py. None default.
     """
     start_time = time.time()
     start_frame = float(utility.get_frame()) if start_frame is None else float(start_frame)
     end_frame = start_frame if end_frame is None else float(end_frame)
-    grps = form_heirarchy([groups.Group(t) for t in templates if t.enabled])
+    if adaptive and (time_context or key_sink is not None): raise RuntimeError("Adaptive matching checks keys as it goes. It cannot be used with time_context or key_sink.")
+    if incremental and (adaptive or cache is None): raise RuntimeError("Incremental matching needs a cache of the last match, and cannot be adaptive.")
+    if reduce and (adaptive or key_sink is not None): raise RuntimeError("Reducing keys needs every step solved, and written by the match.")
+    if timing.ACTIVE is not None:
+        matcher = timing.ACTIVE.timed_matcher(matcher)
+    templates = [t for t in templates if t.enabled]
+    plain = [groups.Group(t) for t in templates]
+    grps = match_order(templates, plain, joint)
     if not grps: raise RuntimeError("No templates provided.")
-
+    if time_context:
+        animated = sorted(set(str(b) for a in grps for b in a if b.get_key_times()))
+        if animated: raise RuntimeError("Attributes already animated cannot be matched with time_context: {}".format(", ".join(animated)))
+
+    def emit(event, **data):
+        """ Send event out, if anyone is listening """
+        data["event"] = event
+        data["time"] = time.time() - start_time
+        events(data)
+
+    if events is not None:
+        emit("start", matcher=matcher.__name__, groups=[a.get_name() for a in grps], start_frame=start_frame, end_frame=end_frame)
     print("Matching Groups Now! Using \"%s\"." % matcher.__name__)
     print("Match order: {}".format(", ".join(a.get_name() for a in grps)))
     group_step = 1 / len(grps)
@@ -290,29 +729,258 @@ def match(templates, start_frame=None, end_frame=None, sub_frame=1.0, matcher=op
     # Continue prepositioning while successful.
     cont_hacky = {a: False for a in grps}
     cont_linear = {a: False for a in grps}
+    predictors = {a: Predictor() for a in grps}
+    sink = key_sink if key_sink is not None else element.Key_Sink() if key_chunk or time_context or reduce else None
+    key_chunk = 0 if time_context or key_sink is not None or reduce else key_chunk
+    chunk = [0] # Frames waiting in the sink
+    key_times = {str(b): b.get_key_times() for a in grps for b in a} if reduce and reduce_keys else None
+    solved_dist = {} # {(group, frame): distance} To check reduced keys against.
+    reduced_steps = [] # [(group, frame)] Cached at solved values, to be cached again at their reduced keys.
+    if cache is not None and not isinstance(cache, caching.Solution_Cache):
+        cache = caching.Solution_Cache(cache)
+
+    def flush():
+        """ Write out any waiting keys """
+        if sink is not None and sink is not key_sink and chunk[0]:
+            timing.set_context()
+            if reduce:
+                reduced = curves.reduce_keys(sink, reduce, key_times, sub_frame)
+                print("Reduced %s keys to %s." % (len(sink), len(reduced)))
+                reduced.flush()
+                if reduce_distance is None:
+                    sink.keys.clear()
+                else:
+                    restore()
+            sink.flush()
+            chunk[0] = 0
+            recache()
+
+    def recache():
+        """ Cache reduced steps at the values actually keyed, so they match when checked next time """
+        for grp, frame in reduced_steps:
+            with element.Context(frame):
+                grp.clear_cache()
+                cache.add(grp, frame, grp.get_values())
+        del reduced_steps[:]
+        for grp in grps:
+            grp.clear_cache()
+
+    def restore():
+        """ Put solved keys back on steps where reducing moved the markers too far. Leaving them in the sink. """
+        keys = dict((str(a), b) for a, b in sink.keys.items())
+        sink.keys = collections.OrderedDict()
+        for (grp, frame), dist in solved_dist.items():
+            with element.Context(frame):
+                grp.clear_cache()
+                if grp.get_distance() - dist > reduce_distance:
+                    for attr in grp:
+                        sink.add(attr, frame, keys[str(attr)][frame])
+        for grp in grps:
+            grp.clear_cache()
+
+    def solve(frame, first=False):
+        """ Match all groups on a frame """
+        with at_frame(frame, time_context):
+            for progress in solve_groups(frame, first):
+                yield progress
+
+    def prepare(grp, frame, first):
+        """ Get group ready to match on frame. True if it was found in the cache, and needs no more. """
+        timing.set_context(grp.name, frame)
+        if adaptive: # Frames are visited out of order, pick up the keyed values.
+            grp.clear_cache()
+        if cache is not None:
+            vals = cache.get(grp, frame)
+            if vals is not None: # Nothing changed since last time
+                grp.keyframe(vals, sink, frame)
+                predictors[grp].add(frame, vals)
+                if reduce:
+                    reduced_steps.append((grp, frame))
+                if events is not None:
+                    snapshot = grp.get_snapshot()
+                    emit("solved", frame=frame, group=grp.name, distance=snapshot.dist, cost=snapshot.cost, calls=grp.get_calls(), cached=True)
+                return True
+        if predict and not first:
+            guess = predictors[grp].predict(frame)
+            if guess is not None:
+                current = grp.get_snapshot()
+                predicted, = grp.evaluate_batch([list(grp.bounds(guess))])
+                if predicted.dist > current.dist: # Guessed wrong. Go back.
+                    grp.set_values(current.vals)
+        if prepos:
+            if first or cont_hacky[grp]:
+                cont_hacky[grp] = success = utility.hacky_snap(grp)
+                if first and success: print("Direct Snapped %s." % grp.name) # Hack for translates and rotates
+            if first or cont_linear[grp]:
+                cont_linear[grp] = success = linear_jump(grp)
+                if first and success: print("Linear Jumpped %s." % grp.name) # Make a quick attempt at linearly shortcutting our way there.
+        return False
+
+    def finish(grp, frame, snapshot):
+        """ Key the result of matching group on frame """
+        if events is not None:
+            emit("solved", frame=frame, group=grp.name, distance=snapshot.dist, cost=snapshot.cost, calls=grp.get_calls(), cached=False)
+        grp.keyframe(snapshot.vals, sink, frame)
+        predictors[grp].add(frame, snapshot.vals)
+        if reduce_distance is not None:
+            solved_dist[grp, frame] = snapshot.dist
+        if cache is not None:
+            cache.add(grp, frame, grp.bounds(snapshot.vals))
+            if reduce:
+                reduced_steps.append((grp, frame))
+
+    def solve_groups(frame, first):
+        if budget or budget_time:
+            for progress in solve_scheduled(frame, first):
+                yield progress
+        else:
+            for j, grp in enumerate(grps):
+                if prepare(grp, frame, first):
+                    continue
+                total_dist = grp.get_distance()
+                total_scale = total_dist and 1.0 / total_dist
+                for iteration, snapshot in enumerate(matcher(grp, **kwargs)):
+                    if events is not None:
+                        emit("step", frame=frame, group=grp.name, iteration=iteration, distance=snapshot.dist, cost=snapshot.cost, calls=grp.get_calls())
+                    if snapshot.dist < match_tolerance: break
+                    progress = 1 - snapshot.dist * total_scale
+                    yield progress * group_step + j * group_step
+                finish(grp, frame, snapshot)
+        chunk[0] += 1
+        if key_chunk and chunk[0] >= key_chunk:
+            flush()
+
+    def solve_scheduled(frame, first):
+        """ Step every groups matcher in turn, giving the budget to whichever is improving the most per call """
+        unique = list(collections.OrderedDict.fromkeys(grps)) # Groups in a cycle take turns anyway
+        steps = {}
+        best = {}
+        gain = {} # Recent distance gained per call. None until tried.
+        dist = {}
+        iterations = {}
+        tried = set() # Groups that have taken their first step
+        for grp in unique:
+            if not prepare(grp, frame, first):
+                steps[grp] = matcher(grp, **kwargs)
+                gain[grp] = None
+                best[grp] = grp.get_snapshot() # Where it was prepared. Keyed if the budget runs out first.
+                dist[grp] = best[grp].dist
+        start_calls = sum(a.get_calls() for a in unique)
+        end_time = time.time() + budget_time if budget_time else None
+        total_dist = sum(dist.values()) or 1
+        while steps:
+            grp = max(steps, key=lambda x: float("inf") if gain[x] is None else gain[x]) # Everyone gets a go
+            timing.set_context(grp.name, frame)
+            calls = grp.get_calls()
+            try:
+                snapshot = next(steps[grp])
+            except StopIteration:
+                del steps[grp]
+                continue
+            grp.set_values(snapshot.vals) # Leave the group where its matcher thinks it is, for the others
+            if events is not None:
+                iterations[grp] = iterations.get(grp, -1) + 1
+                emit("step", frame=frame, group=grp.name, iteration=iterations[grp], distance=snapshot.dist, cost=snapshot.cost, calls=grp.get_calls())
+            if snapshot.dist < best[grp].dist:
+                best[grp] = snapshot
+            if grp not in tried: # First step is usually where we started. Nothing to measure yet.
+                tried.add(grp)
+            else:
+                step = (dist[grp] - best[grp].dist) / max(1, grp.get_calls() - calls)
+                gain[grp] = step if gain[grp] is None else (gain[grp] + step) * 0.5
+            dist[grp] = best[grp].dist
+            if snapshot.dist < match_tolerance:
+                del steps[grp]
+            if budget and sum(a.get_calls() for a in unique) - start_calls >= budget:
+                break
+            if end_time is not None and time.time() >= end_time:
+                break
+            yield 1 - sum(a.dist for a in best.values()) / total_dist
+        for grp in unique: # Key in order, parents first
+            if grp in best:
+                timing.set_context(grp.name, frame)
+                finish(grp, frame, best[grp])
+
+    def warm(frame):
+        """ Start predicting from the keys leading up to frame """
+        for grp in grps:
+            predictors[grp] = predictor = Predictor()
+            for step in (2, 1):
+                with element.Context(frame - step * sub_frame):
+                    grp.clear_cache()
+                    predictor.add(frame - step * sub_frame, grp.get_values())
+            grp.clear_cache()
+
+    def dirty():
+        """ Steps where markers have moved since they were cached, padded by margin """
+        result = set()
+        for i in xrange(frames):
+            with element.Context(i * sub_frame + start_frame): # Only reading, no need to change frames
+                for grp in grps:
+                    grp.clear_cache()
+                if any(cache.changed(grp, i * sub_frame + start_frame) for grp in grps):
+                    result.update(xrange(max(0, i - margin), min(frames, i + margin + 1)))
+        for grp in grps:
+            grp.clear_cache()
+        return sorted(result)
+
+    def drift(frame):
+        """ Furthest distance of any group, using the values already on the frame """
+        flush()
+        result = 0
+        with element.Context(frame): # Only reading, no need to change frames
+            for grp in grps:
+                grp.clear_cache()
+                result = max(result, grp.get_distance())
+        return result
 
     yield 0.0 # Kick us off
     frames = int((end_frame - start_frame) / sub_frame) + 1
-    for i in range(frames):
-        frame = i * sub_frame + start_frame
-        utility.set_frame(frame)
-        for j, grp in enumerate(grps):
-            # grp.clear_cache()
-            if prepos:
-                if not i or cont_hacky[grp]:
-                    cont_hacky[grp] = success = utility.hacky_snap(grp)
-                    if not i and success: print("Direct Snapped %s." % grp.name) # Hack for translates and rotates
-                if not i or cont_linear[grp]:
-                    cont_linear[grp] = success = linear_jump(grp)
-                    if not i and success: print("Linear Jumpped %s." % grp.name) # Make a quick attempt at linearly shortcutting our way there.
-            total_dist = grp.get_distance()
-            total_scale = total_dist and 1.0 / total_dist
-            for snapshot in matcher(grp, **kwargs):
-                if snapshot.dist < match_tolerance: break
-                progress = 1 - snapshot.dist * total_scale
-                yield progress * group_step + j * group_step
-            grp.keyframe(snapshot.vals)
+    if incremental:
+        solved = dirty()
+        starts = set(solved)
+        starts = set(a for a in starts if a - 1 not in starts)
+    else:
+        solved = list(range(0, frames, adaptive or 1))
+        if solved and solved[-1] != frames - 1: # Nothing to solve if the range is empty
+            solved.append(frames - 1)
+        starts = set(solved[:1])
+    try:
+        for i in solved:
+            if incremental and i in starts:
+                warm(i * sub_frame + start_frame)
+            for progress in solve(i * sub_frame + start_frame, i in starts and not incremental):
+                yield progress
+
+        # Split up gaps that cannot be interpolated, until they can be.
+        gaps = [(a, b) for a, b in izip(solved, solved[1:]) if b - a > 1] if adaptive else []
+        while gaps:
+            a, b = gaps.pop()
+            if max(drift(i * sub_frame + start_frame) for i in xrange(a + 1, b)) > adaptive_tolerance:
+                mid = (a + b) // 2
+                for progress in solve(mid * sub_frame + start_frame):
+                    yield progress
+                solved.append(mid)
+                gaps.extend(c for c in ((a, mid), (mid, b)) if c[1] - c[0] > 1)
+    finally: # Keep what was solved, even if stopped early
+        flush()
+        if cache is not None:
+            cache.save()
+        for grp in grps: # Groups matched jointly share the choice
+            if isinstance(grp, groups.Composite_Group) and grp.matcher is not None:
+                for member in grp.groups:
+                    member.matcher = grp.matcher
+        for template, grp in izip(templates, plain): # Remember choices made by optim_auto
+            template.matcher = grp.matcher or template.matcher
+
     calls = sum(a.get_calls() for a in grps)
+    memo_hits = sum(a.memo_hits for a in grps)
+    memo_misses = sum(a.memo_misses for a in grps)
+    if events is not None:
+        emit("end", calls=calls, frames=frames, solved=len(solved), memo_hits=memo_hits, memo_misses=memo_misses)
     print("Match complete. Took,", time.time() - start_time)
-    print("Used %s calls. %s calls per frame." % (calls, frames and calls / frames))
+    print("Used %s calls. %s calls per frame. Solved %s of %s frames." % (calls, frames and calls / frames, len(solved), frames))
+    print("Reused %s evaluations. Measured %s." % (memo_hits, memo_misses))
+    if cache is not None:
+        print("Reused %s cached solutions. Missed %s." % (cache.hits, cache.misses))
     yield 1.0
@@ -1,32 +1,17 @@
 import maya.cmds as cmds
 
 import element
-import math
+import groups
 import sys
 
-def custom(q1 ,q2):
-    diff = (a-b for a,b in zip(q1, q2))
-    # diff = (q1[i]-q2[i] for i in range(3))
-    mag2 = sum(a*a for a in diff)
-    return 5 * mag2
+def get_cost(q1, q2, metric="aprox_angle"):
+    """ Cost of rotational distance, using one of the metrics in groups.METRICS """
+    _, (_, residual, warp) = groups.get_metric(groups.ROTATION, metric)
+    sign = -1 if sum(a*b for a,b in zip(q1,q2)) < 0 else 1
+    dist = residual(sum((b - a*sign)**2 for a, b in zip(q1, q2)))
+    return warp(dist or sys.float_info.min)
 
-def aprox_angle(q1, q2):
-    dot = sum(a*b for a,b in zip(q1,q2))
-    res = 1 - dot * dot
-    return math.log(res if res > 0 else sys.float_info.min, 1.2)
-
-def angle(q1, q2):
-    dot = sum(a*b for a,b in zip(q1,q2))
-    angle = 2 * dot**2 - 1
-    return 2 * math.acos(angle)
-
-def linear(q1, q2):
-    diff = (a-b for a,b in zip(q1, q2))
-    mag2 = sum(a*a for a in diff)
-    res = (mag2 and (mag2 ** -0.5) * mag2)
-    return 10 * (res and math.log(res))
-
-def main():
+def main(metric="aprox_angle"):
     cmds.file(new=True, force=True)
 
     p1, _ = cmds.polyCube()
@@ -41,7 +26,7 @@ def main():
             for z in range(-360, 360, 30):
                 cmds.xform(p2, ro=(x,y,z))
                 quat = m2.get_rotation()
-                dist = aprox_angle(root, quat)
+                dist = get_cost(root, quat, metric)
                 points[x,y,z] = dist
 
     locs = {(x,z): cmds.spaceLocator()[0] for x in range(-360, 360, 30) for z in range(-360, 360, 30)}
@@ -0,0 +1,133 @@
+# Split matching across worker processes
+# Created By Jason Dixon. http://internetimagery.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is a labor of love, and therefore is distributed
+# in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# Each worker loads the scene, solves its chunk of frames and hands its keys back.
+# Keys are merged back into the scene in frame order, so results do not depend on
+# which worker finishes first.
+from __future__ import print_function, division
+import match as matching
+import subprocess
+import element
+import utility
+import os.path
+import groups
+import json
+import sys
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+def get_executable():
+    """ Python to run workers with. mayapy inside maya. """
+    mayapy = os.path.join(os.path.dirname(sys.executable), "mayapy")
+    for path in (mayapy, mayapy + ".exe"):
+        if os.path.isfile(path):
+            return path
+    return sys.executable
+
+def split(start_frame, end_frame, sub_frame=1.0, chunks=1):
+    """ Split frame range into (start, end) chunks of roughly equal size """
+    frames = int((end_frame - start_frame) / sub_frame) + 1
+    chunks = max(1, min(chunks, frames))
+    bounds = [i * frames // chunks for i in xrange(chunks + 1)]
+    return [(a * sub_frame + start_frame, (b - 1) * sub_frame + start_frame) for a, b in zip(bounds, bounds[1:])]
+
+def solve_chunk(job):
+    """ Solve one chunk of frames. Return keys as [("obj.attr", time, value)] """
+    if job.get("scene") is not None:
+        utility.import_scene(job["scene"])
+    sink = element.Key_Sink()
+    progress = matching.match(
+        groups.restore(job["templates"]),
+        job["start"], job["end"], job["sub_frame"],
+        matcher=getattr(matching, job["matcher"]),
+        key_sink=sink, **job["kwargs"])
+    for _ in progress:
+        pass
+    keep = job["keep"] # Seed frames are only there to warm up
+    return sorted((str(a), b, c) for a, d in sink.keys.items() for b, c in d.items() if b >= keep)
+
+def worker_main():
+    """ Entry point for worker processes. Job comes in on stdin, keys go out on stdout. """
+    try:
+        import maya.standalone
+        maya.standalone.initialize()
+    except ImportError:
+        pass
+    job = json.loads(sys.stdin.read())
+    stdout, sys.stdout = sys.stdout, sys.stderr # Keep chatter out of the result
+    try:
+        keys = solve_chunk(job)
+    finally:
+        sys.stdout = stdout
+    json.dump(keys, sys.stdout)
+
+def match(templates, start_frame, end_frame, sub_frame=1.0, chunks=4, seed=2, processes=None, executable=None, matcher=None, **kwargs):
+    """
+    Match groups across frames, splitting the range between worker processes.
+    chunks (optional). Number of pieces to split the range into. 4 default.
+    seed (optional). Steps solved before each chunk, to warm it up. Their keys are thrown away. 2 default.
+    processes (optional). Workers running at once. Number of chunks default.
+    executable (optional). Python to run workers with. mayapy or current python default.
+    Other arguments are passed to match.match in each worker, and must be plain data.
+    Yields progress like match.match. Keys are written once every chunk is done.
+    """
+    matcher = matcher or matching.optim_adam
+    executable = executable or get_executable()
+    processes = processes or chunks
+    scene = utility.export_scene()
+    data = groups.dump(templates)
+    jobs = [{
+        "scene": scene,
+        "templates": data,
+        "start": max(start_frame, start - seed * sub_frame),
+        "end": end,
+        "keep": start,
+        "sub_frame": sub_frame,
+        "matcher": matcher.__name__,
+        "kwargs": kwargs} for start, end in split(start_frame, end_frame, sub_frame, chunks)]
+
+    yield 0.0
+    results = [None] * len(jobs)
+    running = []
+    pending = list(enumerate(jobs))
+    while pending or running:
+        while pending and len(running) < processes:
+            i, job = pending.pop(0)
+            worker = subprocess.Popen([executable, os.path.abspath(__file__).replace(".pyc", ".py")],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            worker.stdin.write(json.dumps(job).encode("utf-8"))
+            worker.stdin.close()
+            running.append((i, worker))
+        i, worker = running.pop(0)
+        output = worker.stdout.read()
+        worker.stdout.close()
+        if worker.wait():
+            raise RuntimeError("Worker for frames {} to {} failed.".format(jobs[i]["keep"], jobs[i]["end"]))
+        results[i] = json.loads(output.decode("utf-8"))
+        yield sum(1 for a in results if a is not None) / (len(jobs) + 1)
+
+    # Merge keys back in frame order
+    attrs = {str(b): b for a in templates if a.enabled for b in groups.Group(a)}
+    sink = element.Key_Sink()
+    for keys in results:
+        for attr, time, value in keys:
+            sink.add(attrs[attr], time, value)
+    sink.flush()
+    yield 1.0
+
+if __name__ == '__main__':
+    worker_main()
@@ -0,0 +1,765 @@
+# Run matching without a host application.
+# python -m pytest test_headless.py
+from __future__ import print_function
+import element_headless as element
+import utility_headless as utility
+import groups
+import tempfile
+import json
+import os.path
+import random
+import math
+import curves
+import timing
+import events
+import cache
+import match
+import shard
+
+SCENE = element.SCENE
+
+def build_scene():
+    """ Two markers. One sitting under a scaled parent. Same scene as test.py """
+    SCENE.new()
+    SCENE.create("m1", tx=random.randrange(-10, 10), ty=-3, tz=random.randrange(-10, 10))
+    SCENE.create("m3", sx=2, sz=6)
+    SCENE.create("m2", parent="m3", tx=random.randrange(-10, 10), tz=random.randrange(-10, 10))
+    return groups.Template(
+        markers=[("m1", "m2")],
+        attributes=[{"obj": "m1", "attr": "tx"}, {"obj": "m2", "attr": "tz"}])
+
+def check_match(matcher, prepos):
+    template = build_scene()
+    for prog in match.match([template], matcher=matcher, start_frame=1, end_frame=5, prepos=prepos):
+        pass
+    x1, _, z1 = element.Marker("m1").get_position()
+    x2, _, z2 = element.Marker("m2").get_position()
+    assert abs(x1-x2) < 1e-3, "Expected %s. Was %s" % (x1, x2)
+    assert abs(z1-z2) < 1e-3, "Expected %s. Was %s" % (z1, z2)
+    return template
+
+def test_matchers():
+    for matcher in (match.optim_adam, match.optim_nelder_mead, match.optim_random):
+        check_match(matcher, False)
+        check_match(matcher, True)
+
+def test_keyframes():
+    check_match(match.optim_adam, False)
+    curve = SCENE.get("m1").curves["tx"]
+    assert curve.times == [1, 2, 3, 4, 5]
+
+def test_heirarchy():
+    SCENE.new()
+    SCENE.create("root", ty=1, ry=90, sx=2, sy=2, sz=2)
+    SCENE.create("joint1", parent="root", tx=1)
+    SCENE.create("joint2", parent="joint1", tx=1, rz=90)
+    SCENE.create("tip", parent="joint2", tx=1)
+    pos = element.Marker("tip").get_position()
+    assert all(abs(a - b) < 1e-6 for a, b in zip(pos, (0, 3, -4))), pos
+
+def test_animation():
+    SCENE.new()
+    SCENE.create("obj")
+    SCENE.set_key("obj", "translateX", 0, 0)
+    SCENE.set_key("obj", "translateX", 10, 5)
+    utility.set_frame(4)
+    assert element.Marker("obj").get_position()[0] == 2
+    attr = element.Attribute(obj="obj", attr="tx")
+    attr.set_value(7) # Lost on frame change, as in maya
+    assert attr.get_value() == 7
+    utility.set_frame(4)
+    assert attr.get_value() == 2
+
+def test_hacky_snap():
+    SCENE.new()
+    SCENE.create("parent", tx=3, rx=30, ry=-20, sx=1.5, sy=1.5, sz=1.5)
+    SCENE.create("child", parent="parent", tx=1, ty=2)
+    SCENE.create("target", tx=-2, ty=4, tz=1, rx=10, ry=45, rz=-60)
+    attrs = [{"obj": "child", "attr": a+b} for a in "tr" for b in "xyz"]
+    grp = groups.Group(groups.Template(match_type=groups.ROTATION, markers=[("child", "target")], attributes=attrs))
+    assert utility.hacky_snap(grp)
+    assert grp.get_distance() < 1e-10
+    grp = groups.Group(groups.Template(markers=[("child", "target")], attributes=attrs))
+    utility.hacky_snap(grp)
+    assert grp.get_distance() < 1e-10
+
+def test_evaluate_batch():
+    grp = groups.Group(build_scene())
+    batch = [(1, 2), (1, 3), (4, 3)]
+    snapshots = grp.evaluate_batch(batch)
+    assert [a.vals for a in snapshots] == batch
+    for vals, snapshot in zip(batch, snapshots):
+        grp.set_values(vals)
+        assert grp.get_snapshot() == snapshot
+    # Backends can take over
+    groups.element.evaluate_batch = lambda group, batch: ["batched"] * len(batch)
+    try:
+        assert grp.evaluate_batch(batch) == ["batched"] * 3
+    finally:
+        del groups.element.evaluate_batch
+
+def test_residuals():
+    SCENE.new()
+    SCENE.create("a", tx=1, ty=2, rx=20, ry=40)
+    SCENE.create("b", tz=-3, ry=-150, rz=10)
+    for match_type in (groups.POSITION, groups.ROTATION, groups.POSE):
+        grp = groups.Group(groups.Template(match_type=match_type, markers=[("a", "b"), ("b", "a")], pose_weight=3))
+        assert abs(grp.residual_distance(grp.get_residuals()) - grp.get_distance()) < 1e-10
+
+def test_levenberg_marquardt():
+    SCENE.new()
+    SCENE.create("a", tx=1, ty=2, rx=20, ry=40)
+    SCENE.create("parent", ty=4, sx=2, sy=2, sz=2)
+    SCENE.create("b", parent="parent", tz=-3, ry=-150, rz=10)
+    attrs = [{"obj": "parent", "attr": a+b} for a in "tr" for b in "xyz"]
+    for match_type in (groups.POSITION, groups.ROTATION):
+        grp = groups.Group(groups.Template(match_type=match_type, markers=[("a", "b")], attributes=attrs))
+        for snapshot in match.optim_levenberg_marquardt(grp):
+            pass
+        assert snapshot.dist < 1e-8, snapshot
+        grp.set_values(snapshot.vals)
+        assert abs(grp.get_distance() - snapshot.dist) < 1e-10
+    check_match(match.optim_levenberg_marquardt, False)
+
+def test_spsa_gradient():
+    template = build_scene()
+    template.attributes = template.attributes[:1]
+    grp = groups.Group(template)
+    finite = grp.get_gradient(1e-5, groups.GRADIENT_FINITE)
+    spsa = grp.get_gradient(1e-5, groups.GRADIENT_SPSA, samples=3)
+    assert abs(finite[0] - spsa[0]) < 1e-3, (finite, spsa)
+    random.seed(0)
+    template = build_scene()
+    template.gradient = groups.GRADIENT_SPSA
+    for snapshot in match.optim_adam(groups.Group(template), samples=2):
+        pass
+    assert abs(snapshot.dist - 3) < 1e-2 # Markers are offset in Y
+
+def test_lbfgs():
+    check_match(match.optim_lbfgs, False)
+    SCENE.new()
+    SCENE.create("a", tx=5, ty=1)
+    SCENE.create("b", tz=-3)
+    attrs = [{"obj": "b", "attr": "t"+a, "min": -2, "max": 2} for a in "xyz"]
+    grp = groups.Group(groups.Template(markers=[("a", "b")], attributes=attrs))
+    seen = []
+    evaluate = grp.evaluate_batch
+    grp.evaluate_batch = lambda batch: seen.extend(batch) or evaluate(batch)
+    for snapshot in match.optim_lbfgs(grp):
+        pass
+    assert all(-2 <= b <= 2 for a in seen for b in a) # Never left the limits
+    assert abs(snapshot.dist - 3) < 1e-6, snapshot
+    assert [round(a, 4) for a in snapshot.vals] == [2, 1, 0]
+
+def test_predictor():
+    predictor = match.Predictor()
+    assert predictor.predict(1) is None
+    for frame in range(6):
+        predictor.add(frame, (3, frame * 2 + 1, frame * frame))
+        guess = predictor.predict(frame + 1)
+    assert [round(a, 6) for a in guess] == [3, 13, 36]
+    check_match(match.optim_levenberg_marquardt, True)
+
+def test_adaptive():
+    SCENE.new()
+    SCENE.create("target")
+    SCENE.set_key("target", "tx", 1, 0)
+    SCENE.set_key("target", "tx", 61, 3)
+    SCENE.set_key("target", "tz", 1, 0.5)
+    SCENE.set_key("target", "tz", 61, 1)
+    SCENE.create("root")
+    SCENE.create("tip", parent="root", tx=2)
+    template = groups.Template(
+        markers=[("tip", "target")],
+        attributes=[{"obj": "root", "attr": "ry"}, {"obj": "root", "attr": "tx"}])
+    for _ in match.match([template], 1, 61, matcher=match.optim_levenberg_marquardt, adaptive=8, adaptive_tolerance=1e-3):
+        pass
+    keys = SCENE.get("root").curves["tx"].times
+    assert 1 in keys and 61 in keys and len(keys) < 30, keys
+    grp = groups.Group(template)
+    for frame in range(1, 62):
+        utility.set_frame(frame)
+        assert grp.get_distance() < 1e-3
+
+    # Empty range. Nothing solved.
+    SCENE.get("root").curves.clear()
+    for _ in match.match([template], 10, 5, adaptive=8):
+        pass
+    assert not SCENE.get("root").curves
+
+def test_key_sink():
+    SCENE.new()
+    SCENE.create("obj", tx=1)
+    attr = element.Attribute(obj="obj", attr="tx")
+    sink = element.Key_Sink()
+    for frame in (3, 1, 2):
+        sink.add(attr, frame, frame * 10)
+    assert len(sink) == 3 and "tx" not in SCENE.get("obj").curves
+    sink.flush()
+    curve = SCENE.get("obj").curves["tx"]
+    assert (curve.times, curve.values) == ([1, 2, 3], [10, 20, 30])
+    assert not len(sink)
+
+    # Stopping early still writes what was solved
+    template = build_scene()
+    progress = match.match([template], 1, 10, matcher=match.optim_levenberg_marquardt)
+    for _ in progress:
+        if utility.get_frame() == 3:
+            break
+    assert "tx" not in SCENE.get("m1").curves
+    progress.close()
+    assert SCENE.get("m1").curves["tx"].times == [1, 2]
+
+def test_time_context():
+    SCENE.new()
+    SCENE.create("obj")
+    SCENE.set_key("obj", "tx", 0, 0)
+    SCENE.set_key("obj", "tx", 10, 10)
+    attr = element.Attribute(obj="obj", attr="tx")
+    utility.set_frame(2)
+    with element.Context(6):
+        assert attr.get_value() == 6
+        attr.set_value(1)
+        assert element.Marker("obj").get_position()[0] == 1
+    assert utility.get_frame() == 2 and attr.get_value() == 2
+
+    template = build_scene()
+    SCENE.set_key("m1", "tz", 1, -5)
+    SCENE.set_key("m1", "tz", 5, 5)
+    utility.set_frame(20)
+    for _ in match.match([template], 1, 5, matcher=match.optim_levenberg_marquardt, time_context=True):
+        pass
+    assert utility.get_frame() == 20
+    grp = groups.Group(template)
+    for frame in range(1, 6):
+        with element.Context(frame):
+            grp.clear_cache()
+            x1, _, z1 = element.Marker("m1").get_position()
+            x2, _, z2 = element.Marker("m2").get_position()
+            assert abs(x1-x2) < 1e-3 and abs(z1-z2) < 1e-3
+
+    # Running again would set values on the keys just made
+    try:
+        for _ in match.match([template], 1, 5, matcher=match.optim_levenberg_marquardt, time_context=True):
+            pass
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("Animated attributes matched in context.")
+
+def test_shard():
+    assert shard.split(1, 10, 1, 3) == [(1, 3), (4, 6), (7, 10)]
+    template = build_scene()
+    SCENE.set_key("m1", "tz", 1, -5)
+    SCENE.set_key("m1", "tz", 20, 5)
+    scene = utility.export_scene()
+    for _ in match.match([template], 1, 20, matcher=match.optim_levenberg_marquardt):
+        pass
+    expected = SCENE.get("m2").curves["tz"].values
+    utility.import_scene(scene)
+    for _ in shard.match([template], 1, 20, chunks=3, matcher=match.optim_levenberg_marquardt):
+        pass
+    curve = SCENE.get("m2").curves["tz"]
+    assert curve.times == list(range(1, 21))
+    assert all(abs(a - b) < 1e-6 for a, b in zip(curve.values, expected))
+
+def test_dependencies():
+    SCENE.new()
+    SCENE.create("root")
+    SCENE.create("arm", parent="root", tx=1)
+    SCENE.create("hand", parent="arm", tx=1)
+    SCENE.create("other", tx=5)
+    SCENE.create("target", tx=2, ty=1)
+    hand = groups.Template(name="hand", markers=[("hand", "target")], attributes=[{"obj": "arm", "attr": "rz"}])
+    root = groups.Template(name="root", markers=[("root", "target")], attributes=[{"obj": "root", "attr": "ty"}])
+    other = groups.Template(name="other", markers=[("other", "target")], attributes=[{"obj": "other", "attr": "tx"}])
+    templates = [hand, other, root]
+    grps = [groups.Group(a) for a in templates]
+    assert [a.name for a in match.form_heirarchy(grps)] == ["other", "root", "hand"]
+    probed = match.probe_children(grps)
+    assert match.get_children(grps) == dict((a, probed[a]) for a in grps)
+
+    # Cycles are solved again in a different order
+    other.attributes.append({"obj": "root", "attr": "tx"})
+    other.markers.append(("root", "target"))
+    grps = [groups.Group(a) for a in templates]
+    assert [a.name for a in match.form_heirarchy(grps)] == ["other", "root", "other", "hand"]
+
+    # Order is cached while the templates stay the same
+    templates = groups.restore(groups.dump(templates))
+    order = [a.name for a in match.match_order(templates, [groups.Group(a) for a in templates])]
+    cached = groups.restore(groups.dump(templates))
+    calls = []
+    query = match.utility.get_influences
+    def get_influences(*args):
+        calls.append(args)
+        return query(*args)
+    match.utility.get_influences = get_influences
+    try:
+        assert [a.name for a in match.match_order(cached, [groups.Group(a) for a in cached])] == order
+        assert not calls
+        cached[0].attributes.pop()
+        match.match_order(cached, [groups.Group(a) for a in cached])
+        assert calls
+    finally:
+        match.utility.get_influences = query
+
+def test_joint():
+    SCENE.new()
+    SCENE.create("a")
+    SCENE.create("b", parent="a")
+    SCENE.create("t1", tx=3)
+    SCENE.create("t2", tx=1, ty=1)
+    templates = [
+        groups.Template(name="A", markers=[("a", "t1"), ("b", "t2")], attributes=[{"obj": "a", "attr": "tx"}]),
+        groups.Template(name="B", match_type=groups.ROTATION, markers=[("b", "t2")],
+            attributes=[{"obj": "b", "attr": "tx"}, {"obj": "b", "attr": "ty"}, {"obj": "a", "attr": "tx"}])]
+    grp, = match.form_heirarchy([groups.Group(a) for a in templates], joint=True)
+    assert grp.name == "A + B" and [str(a) for a in grp] == ["a.tx", "b.tx", "b.ty"]
+    residuals = grp.get_residuals()
+    assert len(residuals) == 3 and abs(grp.residual_distance(residuals) - grp.get_distance()) < 1e-10
+    for _ in match.match(templates, 1, 1, matcher=match.optim_levenberg_marquardt, joint=True):
+        pass
+    assert round(SCENE.get("a").curves["tx"].values[0], 6) == 3
+    assert [round(SCENE.get("b").curves[a].values[0], 6) for a in ("tx", "ty")] == [-2, 1]
+
+    # Groups in a cycle are solved more than once a frame, taking turns
+    for kwargs in ({}, {"budget": 2000}):
+        for _ in match.match(templates, 1, 6, matcher=match.optim_levenberg_marquardt, **kwargs):
+            pass
+        assert len(SCENE.get("b").curves["tx"].values) == 6
+
+    # Groups sharing an attribute in a cycle. The last to solve it is keyed, buffered or not.
+    templates[1].match_type = groups.POSITION
+    keyed = []
+    for key_chunk in (100, 0):
+        for obj in ("a", "b"):
+            SCENE.get(obj).curves.clear()
+            for attr in ("tx", "ty"):
+                element.Attribute(obj=obj, attr=attr).set_value(0)
+        for _ in match.match(templates, 1, 3, matcher=match.optim_levenberg_marquardt, key_chunk=key_chunk):
+            pass
+        keyed.append(SCENE.get("a").curves["tx"].values)
+    assert all(abs(a - b) < 1e-6 for a, b in zip(*keyed)), keyed
+    utility.set_frame(1)
+    assert abs(element.Attribute(obj="a", attr="tx").get_value() - 2.25) < 1e-6
+
+def test_cache():
+    path = cache.get_path(os.path.join(tempfile.mkdtemp(), "test.snap"))
+    template = build_scene()
+    SCENE.set_key("m1", "tz", 1, -5)
+    SCENE.set_key("m1", "tz", 10, 5)
+    for _ in match.match([template], 1, 10, matcher=match.optim_levenberg_marquardt, cache=path):
+        pass
+    expected = SCENE.get("m2").curves["tz"].values
+    solutions = cache.Solution_Cache(path)
+    assert len(solutions) == 10
+
+    # Nothing changed. Nothing solved.
+    SCENE.get("m2").curves.clear()
+    for _ in match.match([template], 1, 10, matcher=match.optim_levenberg_marquardt, cache=solutions):
+        pass
+    assert (solutions.hits, solutions.misses) == (10, 0)
+    assert SCENE.get("m2").curves["tz"].values == expected
+
+    # Markers moved on some frames
+    SCENE.set_key("m1", "tz", 10, 6)
+    solutions = cache.Solution_Cache(path, limit=5)
+    assert len(solutions) == 5
+    for _ in match.match([template], 1, 10, matcher=match.optim_levenberg_marquardt, cache=solutions):
+        pass
+    assert solutions.hits == 0 and solutions.misses == 10 # Oldest frames were dropped, the rest changed
+    utility.set_frame(10)
+    assert abs(element.Marker("m2").get_position()[2] - 6) < 1e-6
+
+def test_incremental():
+    path = os.path.join(tempfile.mkdtemp(), "test.snapcache")
+    template = build_scene()
+    for frame, value in ((1, -5), (10, 0), (20, 3), (30, 5)):
+        SCENE.set_key("m1", "tz", frame, value)
+    for _ in match.match([template], 1, 30, matcher=match.optim_levenberg_marquardt, cache=path):
+        pass
+
+    # Animator tweaks a key. Frames 11 to 29 move.
+    SCENE.set_key("m1", "tz", 20, 4)
+    keys = list(SCENE.get("m2").curves["tz"].values)
+    solutions = cache.Solution_Cache(path)
+    for _ in match.match([template], 1, 30, matcher=match.optim_levenberg_marquardt, cache=solutions, incremental=True, margin=1):
+        pass
+    assert solutions.hits + solutions.misses == 21 # Frames 10 to 30
+    assert SCENE.get("m2").curves["tz"].values[:8] == keys[:8] # Frames left alone keep their keys
+    grp = groups.Group(template)
+    for frame in range(10, 31):
+        utility.set_frame(frame)
+        assert grp.get_distance() < 3 + 1e-6 # Markers are offset in Y
+
+    # Nothing changed, nothing to solve
+    solutions = cache.Solution_Cache(path)
+    for _ in match.match([template], 10, 30, matcher=match.optim_levenberg_marquardt, cache=solutions, incremental=True):
+        pass
+    assert solutions.hits + solutions.misses == 0
+
+def test_reduce():
+    times = list(range(1, 101))
+    values = [a * a * 0.01 + (5 if a > 50 else 0) for a in times]
+    keys = curves.fit(times, values, 1e-3)
+    assert len(keys) < 20 and keys[0][0] == 1 and keys[-1][0] == 100
+    curve = element.Curve()
+    curve.add_keys(dict(a[:2] for a in keys), dict((a[0], a[2]) for a in keys))
+    assert all(abs(curve.evaluate(a) - b) <= 1e-3 for a, b in zip(times, values))
+    keys = curves.fit(times, values, 1e-3, key_times=set([1, 25, 50, 51, 75]))
+    assert [a[0] for a in keys] == [1, 25, 50, 51, 75, 100]
+
+    template = build_scene()
+    SCENE.set_key("m1", "tz", 1, -5)
+    SCENE.set_key("m1", "tz", 15, 5)
+    SCENE.set_key("m1", "tz", 30, -5)
+    SCENE.set_key("m2", "tz", 10, 0) # Existing key times to keep to
+    SCENE.set_key("m2", "tz", 20, 0)
+    for _ in match.match([template], 1, 30, matcher=match.optim_levenberg_marquardt, reduce=1e-3, reduce_keys=True):
+        pass
+    assert SCENE.get("m2").curves["tz"].times == [1, 10, 20, 30]
+
+    for _ in match.match([template], 1, 30, matcher=match.optim_levenberg_marquardt, reduce=1e-3, reduce_distance=1e-3):
+        pass
+    assert len(SCENE.get("m2").curves["tz"]) < 15
+    grp = groups.Group(template)
+    for frame in range(1, 31):
+        utility.set_frame(frame)
+        assert grp.get_distance() < 3 + 1e-3 # Markers are offset in Y
+
+    # Reduced runs keep the keys between them. Cached at the reduced keys.
+    path = os.path.join(tempfile.mkdtemp(), "test.snapcache")
+    SCENE.get("m2").curves.clear()
+    for frame, value in ((1, -5), (6, 2), (10, 0), (15, 4), (20, 1), (25, 5), (30, 0)):
+        SCENE.set_key("m1", "tz", frame, value)
+    for _ in match.match([template], 1, 30, matcher=match.optim_levenberg_marquardt, cache=path, reduce=0.05):
+        pass
+    solutions = cache.Solution_Cache(path)
+    for _ in match.match([template], 1, 30, matcher=match.optim_levenberg_marquardt, cache=solutions, incremental=True):
+        pass
+    assert solutions.hits + solutions.misses == 0
+    SCENE.set_key("m1", "tz", 1, -4)
+    SCENE.set_key("m1", "tz", 30, 6)
+    for _ in match.match([template], 1, 30, matcher=match.optim_levenberg_marquardt, cache=path, incremental=True, reduce=0.05):
+        pass
+    for frame in range(1, 31):
+        utility.set_frame(frame)
+        assert grp.get_distance() < 3 + 0.05
+    solutions = cache.Solution_Cache(path)
+    for _ in match.match([template], 1, 30, matcher=match.optim_levenberg_marquardt, cache=solutions, incremental=True):
+        pass
+    assert solutions.hits + solutions.misses == 0
+
+def test_auto():
+    template = check_match(match.optim_auto, False)
+    assert template.matcher in [a.__name__ for a in match.MATCHERS]
+    assert groups.restore(groups.dump([template]))[0].matcher == template.matcher
+    grp = groups.Group(template)
+    assert grp.matcher == template.matcher and not grp.races # No need to race again
+
+    # Race over a few frames
+    template = build_scene()
+    grp = groups.Group(template)
+    for frame in range(1, 4):
+        utility.set_frame(frame)
+        for snapshot in match.optim_auto(grp, budget=50, race=2):
+            pass
+        assert (grp.matcher is None) == (frame < 2)
+    assert all(len(a) == 2 for a in grp.races.values())
+
+    # Choice made for groups matched jointly is kept too
+    SCENE.new()
+    SCENE.create("a")
+    SCENE.create("b", parent="a")
+    SCENE.create("t1", tx=3)
+    templates = [
+        groups.Template(name="A", markers=[("a", "t1")], attributes=[{"obj": "b", "attr": "tx"}]),
+        groups.Template(name="B", markers=[("b", "t1")], attributes=[{"obj": "a", "attr": "tx"}])]
+    for _ in match.match(templates, 1, 1, matcher=match.optim_auto, prepos=False, joint=True):
+        pass
+    assert templates[0].matcher is not None and templates[0].matcher == templates[1].matcher
+    grp, = match.form_heirarchy([groups.Group(a) for a in templates], joint=True)
+    assert grp.matcher == templates[0].matcher
+
+def test_budget():
+    SCENE.new()
+    SCENE.create("a", tx=3, ty=1)
+    SCENE.create("b")
+    SCENE.create("c", tx=-4, tz=2)
+    SCENE.create("d")
+    easy = groups.Template(name="easy", markers=[("a", "b")], attributes=[{"obj": "b", "attr": "t"+a} for a in "xyz"])
+    hard = groups.Template(name="hard", markers=[("c", "d")], attributes=[{"obj": "d", "attr": a+b} for a in "trs" for b in "xyz"])
+    grps = [groups.Group(a) for a in (easy, hard)]
+    start = [a.get_distance() for a in grps]
+    seen = set()
+    def optim_seen(group):
+        seen.add(group)
+        for snapshot in match.optim_adam(group):
+            yield snapshot
+    for _ in match.match([easy, hard], 1, 3, matcher=optim_seen, prepos=False, budget=300):
+        pass
+    assert sum(a.get_calls() for a in seen) < 3 * 450 # Budget, give or take a step
+    utility.set_frame(3)
+    for grp, dist in zip(grps, start):
+        assert len(SCENE.get(grp.attributes[0].obj).curves["tx"]) == 3 # Everyone gets keyed
+        assert grp.get_distance() < dist * 0.5 # Everyone gets a share
+
+    # Budget runs out before everyone has had a step. Still keyed where they were prepared.
+    SCENE.new()
+    templates = []
+    for name in "abc":
+        SCENE.create(name, tx=2)
+        SCENE.create(name + "_target")
+        templates.append(groups.Template(name=name, markers=[(name, name + "_target")], attributes=[{"obj": name, "attr": "tx"}]))
+    for _ in match.match(templates, 1, 3, matcher=match.optim_adam, prepos=False, budget=5):
+        pass
+    for name in "abc":
+        assert len(SCENE.get(name).curves["tx"]) == 3
+
+    # Groups in a cycle are scheduled once a frame
+    SCENE.new()
+    SCENE.create("a")
+    SCENE.create("b", parent="a")
+    SCENE.create("t1", tx=3)
+    SCENE.create("t2", tx=1, ty=1)
+    templates = [
+        groups.Template(name="A", markers=[("a", "t1"), ("b", "t2")], attributes=[{"obj": "a", "attr": "tx"}]),
+        groups.Template(name="B", markers=[("b", "t2")], attributes=[{"obj": "b", "attr": "tx"}, {"obj": "a", "attr": "tx"}])]
+    solved = []
+    def collect(event):
+        if event["event"] == "solved":
+            solved.append(event["group"])
+    for _ in match.match(templates, 1, 2, matcher=match.optim_adam, prepos=False, budget=200, events=collect):
+        pass
+    assert sorted(solved) == ["A", "A", "B", "B"]
+
+def test_anytime():
+    template = build_scene()
+    SCENE.set_key("m1", "tz", 1, -5)
+    SCENE.set_key("m1", "tz", 10, 5)
+    utility.set_frame(1)
+    live = match.Anytime([template], deadline=0)
+    assert not live.solve() # No time to do anything
+    assert live.refine(10)
+    assert abs(live.get_distance() - 3) < 1e-6 # Markers are offset in Y
+    grp = groups.Group(template)
+    assert abs(grp.get_distance() - 3) < 1e-6 # Best is applied
+
+    # Follow the frame when idle
+    live.start()
+    try:
+        live.deadline = 10
+        utility.set_frame(7)
+        utility.run_idle()
+        assert live.frame == 7
+        grp.clear_cache()
+        assert abs(grp.get_distance() - 3) < 1e-6
+    finally:
+        live.stop()
+    assert not utility.IDLE
+
+def test_timing():
+    get_value = groups.WrapAttr.__dict__["get_value"]
+    template = build_scene()
+    with timing.Profiler() as profiler:
+        for _ in match.match([template], 1, 3, matcher=match.optim_adam):
+            pass
+    assert groups.WrapAttr.__dict__["get_value"] is get_value # Put back
+    totals = profiler.get_totals()
+    for operation in ("attribute set", "distance", "gradient", "keyframe", "write keys", "hacky snap", "linear jump", "matcher step"):
+        assert totals[operation][0], operation
+    frames = profiler.get_totals(lambda group, frame, operation: frame)
+    assert set(frames) == set([None, 1, 2, 3])
+    assert "matcher step" in profiler.summary()
+    path = os.path.join(tempfile.mkdtemp(), "trace.json")
+    profiler.save(path)
+    with open(path) as f:
+        assert len(json.load(f)) == len(profiler.records)
+
+def test_events():
+    template = build_scene()
+    path = os.path.join(tempfile.mkdtemp(), "events.jsonl")
+    with events.JSON_Lines(path) as sink:
+        for _ in match.match([template], 1, 3, matcher=match.optim_levenberg_marquardt, events=sink):
+            pass
+    with open(path) as f:
+        stream = [json.loads(a) for a in f]
+    assert stream[0]["event"] == "start" and stream[-1]["event"] == "end"
+    solved = [a for a in stream if a["event"] == "solved"]
+    assert [a["frame"] for a in solved] == [1, 2, 3]
+    steps = [a for a in stream if a["event"] == "step"]
+    assert steps and all(set(("frame", "group", "iteration", "distance", "cost", "calls")) <= set(a) for a in steps)
+    assert stream[-1]["calls"] >= solved[-1]["calls"]
+
+    seen = []
+    update = events.Throttle(seen.append, rate=1)
+    for value in (0, 0.1, 0.2, 1):
+        update(value)
+    assert seen == [0, 1]
+
+def test_marker_cache():
+    SCENE.new()
+    SCENE.create("driver", tx=3, tz=-2)
+    SCENE.create("target", tx=-4, tz=5)
+    template = groups.Template(
+        markers=[("driver", "target")],
+        attributes=[{"obj": "driver", "attr": "tx"}, {"obj": "driver", "attr": "tz"}])
+    grp = groups.Group(template)
+    driver, target = grp.markers[0]
+    for i in range(5):
+        grp.set_values((i, -i))
+        assert abs(grp.get_distance() - element.Marker_Set("driver", "target").get_pos_distance()) < 1e-9
+    assert (driver.reads, target.reads) == (5, 1) # Only the driver moves
+
+    # Anything outside the group moving the markers is caught
+    SCENE.set_key("target", "tx", 1, 2)
+    assert abs(grp.get_distance() - element.Marker_Set("driver", "target").get_pos_distance()) < 1e-9
+    assert target.reads == 2
+    with element.Context(1):
+        grp.get_distance()
+    assert target.reads == 3
+
+    for _ in match.match([template], 1, 3, matcher=match.optim_levenberg_marquardt):
+        pass
+    assert element.Marker_Set("driver", "target").get_pos_distance() < 1e-4
+
+def test_components():
+    SCENE.new()
+    SCENE.create("root", tx=1, sx=2)
+    SCENE.create("mesh", parent="root", ty=3, rz=90)
+    SCENE.add_mesh("mesh", # Two quads side by side
+        [(0, 0, 0), (1, 0, 0), (1, 0, 1), (0, 0, 1), (2, 0, 0), (2, 0, 1)],
+        [(0, 1, 2, 3), (1, 4, 5, 2)])
+    SCENE.create("loc", tx=5, tz=5)
+    world = SCENE.get("mesh").world_matrix()
+    def center(points):
+        x, y, z = (sum(a) / float(len(points)) for a in zip(*points))
+        return [x * world[a] + y * world[a + 4] + z * world[a + 8] + world[a + 12] for a in range(3)]
+
+    for name, points in (
+        ("mesh.vtx[1:2]", [(1, 0, 0), (1, 0, 1)]),
+        ("mesh.e[1]", [(1, 0, 0), (1, 0, 1)]),
+        ("mesh.f[1]", [(1, 0, 0), (2, 0, 0), (2, 0, 1), (1, 0, 1)]),
+        ("mesh.f[0:1]", SCENE.get("mesh").points)):
+        assert utility.valid_object(name)
+        marker = element.get_marker(name)
+        assert all(abs(a - b) < 1e-9 for a, b in zip(marker.get_position(), center(points)))
+        assert marker.get_rotation() == element.Marker("mesh").get_rotation()
+    assert not utility.valid_object("loc.vtx[0]")
+
+    template = groups.Template(
+        markers=[("loc", "mesh.f[1]")],
+        attributes=[{"obj": "loc", "attr": a} for a in ("tx", "ty", "tz")])
+    utility.import_scene(utility.export_scene()) # Meshes survive the trip to workers
+    for _ in match.match([template], 1, 1, matcher=match.optim_levenberg_marquardt):
+        pass
+    assert element.Marker_Set("loc", "mesh.f[1]").get_pos_distance() < 1e-4
+
+def test_pose():
+    SCENE.new()
+    SCENE.create("a", tx=1, ty=2, rx=20, ry=40)
+    SCENE.create("parent", ty=4, sx=2, sy=2, sz=2)
+    SCENE.create("b", parent="parent", tz=-3, ry=-150, rz=10)
+    attrs = [{"obj": "parent", "attr": a+b} for a in "tr" for b in "xyz"]
+    template = groups.Template(match_type=groups.POSE, markers=[("a", "b")], attributes=attrs, pose_weight=2)
+    assert groups.restore(groups.dump([template]))[0].pose_weight == 2
+    for matcher in (match.optim_levenberg_marquardt, match.optim_lbfgs):
+        grp = groups.Group(template)
+        for snapshot in matcher(grp):
+            pass
+        assert snapshot.dist < 1e-6, (matcher, snapshot)
+        grp.set_values(snapshot.vals)
+        assert element.Marker_Set("a", "b").get_pos_distance() < 1e-6
+        assert element.Marker_Set("a", "b").get_rot_distance() < 1e-6
+
+    # One matrix read for each marker, per evaluation
+    grp = groups.Group(template)
+    grp.set_values([0] * 6)
+    grp.get_distance()
+    grp.get_residuals()
+    assert grp.get_calls() == 6 + 2 # Attributes set, and each marker read once
+
+def test_metrics():
+    SCENE.new()
+    SCENE.create("a", tx=1, ty=2, rx=20, ry=40)
+    SCENE.create("parent", ty=4, sx=2, sy=2, sz=2)
+    SCENE.create("b", parent="parent", tz=-3, ry=-150, rz=10)
+    attrs = [{"obj": "parent", "attr": a+b} for a in "tr" for b in "xyz"]
+    for match_type, metrics in groups.METRICS.items():
+        for name in metrics:
+            template = groups.Template(match_type=match_type, markers=[("a", "b"), ("b", "a")], attributes=attrs, metric=name)
+            template, = groups.restore(groups.dump([template]))
+            grp = groups.Group(template)
+            assert grp.metric == name
+            assert abs(grp.residual_distance(grp.get_residuals()) - grp.get_distance()) < 1e-10, name
+            for snapshot in match.optim_levenberg_marquardt(grp):
+                pass
+            assert snapshot.dist < 1e-4, (match_type, name, snapshot)
+            grp.set_values([0] * 6)
+
+    assert groups.Group(groups.Template(match_type=groups.ROTATION)).metric == "aprox_angle" # Default
+    for match_type, metric in ((groups.POSITION, "nope"), (5, None)):
+        try:
+            groups.Group(groups.Template(match_type=match_type, metric=metric))
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("Bad metric accepted.")
+
+def test_memo():
+    template = build_scene()
+    grp = groups.Group(template)
+    first = grp.get_snapshot()
+    calls = grp.get_calls()
+    grp.set_values([a + 1 for a in first.vals])
+    grp.set_values(first.vals)
+    assert grp.get_snapshot() == first # Revisited. Markers not read again.
+    assert grp.get_calls() == calls + 2 * len(grp) and grp.memo_hits == 1
+
+    # Candidates seen before are not set again
+    probes = [[a + 1 for a in first.vals], list(first.vals)]
+    calls = grp.get_calls()
+    snapshots = grp.evaluate_batch(probes)
+    assert snapshots[1] == first and grp.memo_hits == 2
+    assert grp.evaluate_batch(probes) == snapshots and grp.memo_hits == 4
+    assert grp.get_values() == tuple(first.vals)
+
+    # Markers moved some other way
+    SCENE.set_key("m1", "ty", 0, 5)
+    assert grp.get_snapshot().dist != first.dist and grp.memo_hits == 4
+    with element.Context(1):
+        grp.get_snapshot()
+    assert grp.memo_hits == 4
+
+    grp.init_memo(limit=3)
+    for i in range(5):
+        grp.set_values([i, i])
+        grp.get_snapshot()
+    assert len(grp.memo) == 3
+    grp.set_values([0, 0])
+    grp.get_snapshot()
+    assert grp.memo_hits == 0 and grp.memo_misses == 6 # Oldest were dropped
+
+    # Another group setting a different attribute on the same node
+    SCENE.new()
+    SCENE.create("obj")
+    SCENE.create("target", tx=3)
+    grp_a, grp_b = (groups.Group(groups.Template(markers=[("obj", "target")], attributes=[{"obj": "obj", "attr": a}])) for a in ("tx", "ty"))
+    assert grp_a.get_snapshot().dist == 3
+    grp_b.set_values([5])
+    assert abs(grp_a.get_snapshot().dist - math.sqrt(34)) < 1e-9
+
+def main():
+    for test in (test_matchers, test_keyframes, test_heirarchy, test_animation, test_hacky_snap, test_evaluate_batch,
+        test_residuals, test_levenberg_marquardt, test_spsa_gradient,
+        test_lbfgs, test_predictor, test_adaptive, test_key_sink, test_time_context,
+        test_shard, test_dependencies, test_joint, test_cache,
+        test_incremental, test_reduce, test_auto, test_budget,
+        test_anytime, test_timing, test_events, test_marker_cache, test_components,
+        test_pose, test_metrics, test_memo):
+        test()
+    print("="*20)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Find out where matching spends its time
+# Created By Jason Dixon. http://internetimagery.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is a labor of love, and therefore is distributed
+# in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# Timers are only swapped in while a Profiler is active. Otherwise nothing is touched.
+#
+#   with timing.Profiler() as profiler:
+#       for progress in match.match(templates, 1, 100): pass
+#   print(profiler.summary())
+#   profiler.save("trace.json")
+from __future__ import print_function, division
+import collections
+import element
+import utility
+import groups
+import json
+import time
+
+clock = getattr(time, "perf_counter", time.time)
+
+ACTIVE = None # Profiler currently recording
+OUTER = ("matcher step", "hacky snap", "linear jump", "keyframe", "write keys") # Operations not nested in each other
+
+def set_context(group=None, frame=None):
+    """ Note what is being matched, so operations can be attributed to it """
+    if ACTIVE is not None:
+        ACTIVE.group = group
+        ACTIVE.frame = frame
+
+class Profiler(object):
+    """ Record count and time of operations, for each group and frame. Use as a context manager around matching. """
+    def __init__(s):
+        import match # Avoid circular import
+        s.group = s.frame = None
+        s.records = collections.OrderedDict() # {(group, frame, operation): [count, seconds]}
+        s.targets = [ # (owner, name, operation)
+            (groups.WrapAttr, "get_value", "attribute get"),
+            (groups.WrapAttr, "set_value", "attribute set"),
+            (element.Marker_Set, "get_pos_distance", "distance"),
+            (element.Marker_Set, "get_rot_distance", "distance"),
+            (element.Marker_Set, "get_pose_distance", "distance"),
+            (element.Marker_Set, "get_pos_residual", "residual"),
+            (element.Marker_Set, "get_rot_residual", "residual"),
+            (element.Marker_Set, "get_pose_residual", "residual"),
+            (groups.Group, "get_gradient", "gradient"),
+            (groups.Group, "keyframe", "keyframe"),
+            (element.Key_Sink, "flush", "write keys"),
+            (utility, "hacky_snap", "hacky snap"),
+            (match, "linear_jump", "linear jump")]
+        s.originals = []
+
+    def __enter__(s):
+        global ACTIVE
+        if ACTIVE is not None: raise RuntimeError("Already profiling.")
+        for owner, name, operation in s.targets:
+            original = owner.__dict__[name]
+            s.originals.append((owner, name, original))
+            setattr(owner, name, s.timed(original, operation))
+        ACTIVE = s
+        return s
+
+    def __exit__(s, *_):
+        global ACTIVE
+        for owner, name, original in reversed(s.originals):
+            setattr(owner, name, original)
+        s.originals = []
+        ACTIVE = None
+
+    def add(s, operation, seconds):
+        """ Record one run of operation """
+        record = s.records.get((s.group, s.frame, operation))
+        if record is None:
+            record = s.records[s.group, s.frame, operation] = [0, 0.0]
+        record[0] += 1
+        record[1] += seconds
+
+    def timed(s, func, operation):
+        """ Wrap function to record its time """
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                s.add(operation, clock() - start)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def timed_matcher(s, matcher):
+        """ Wrap matcher to record the time of each step """
+        def wrapper(group, **kwargs):
+            steps = matcher(group, **kwargs)
+            while True:
+                start = clock()
+                try:
+                    snapshot = next(steps)
+                except StopIteration:
+                    return
+                finally:
+                    s.add("matcher step", clock() - start)
+                yield snapshot
+        wrapper.__name__ = matcher.__name__
+        return wrapper
+
+    def get_totals(s, key=lambda group, frame, operation: operation, operations=None):
+        """ Add records up by key, optionally only for some operations. {key: [count, seconds]} """
+        totals = collections.OrderedDict()
+        for record, (count, seconds) in s.records.items():
+            if operations is not None and record[2] not in operations:
+                continue
+            total = totals.setdefault(key(*record), [0, 0.0])
+            total[0] += count
+            total[1] += seconds
+        return totals
+
+    def dump(s):
+        """ Records as plain data """
+        return [{"group": a, "frame": b, "operation": c, "count": d, "seconds": e} for (a, b, c), (d, e) in s.records.items()]
+
+    def save(s, file_path):
+        """ Write records out as a json trace """
+        with open(file_path, "w") as f:
+            json.dump(s.dump(), f, indent=4)
+
+    def summary(s):
+        """ Table of totals for each operation, then each group. Operation times include operations nested within. """
+        lines = []
+        for title, totals in (
+            ("Operation", s.get_totals()),
+            ("Group", s.get_totals(lambda group, frame, operation: group, OUTER))):
+            lines.append("{:<24}{:>10}{:>12}{:>12}".format(title, "Count", "Seconds", "Per Call"))
+            for name, (count, seconds) in sorted(totals.items(), key=lambda x: -x[1][1]):
+                lines.append("{:<24}{:>10}{:>12.4f}{:>12.6f}".format(str(name), count, seconds, seconds / count))
+            lines.append("")
+        return "\n".join(lines)
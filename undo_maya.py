@@ -0,0 +1,74 @@
+# Put changes made through the API onto mayas undo queue
+# Created By Jason Dixon. http://internetimagery.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is a labor of love, and therefore is distributed
+# in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# Changes recorded in an MDGModifier or MAnimCurveChange are already done, but not undoable.
+# register() hands them to a small command, loaded from this file as a plugin, which
+# maya then keeps on the undo queue like any other.
+#
+#   change = oma.MAnimCurveChange()
+#   curve.addKeys(times, values, ..., change)
+#   undo_maya.register(change)
+from __future__ import print_function
+import maya.api.OpenMaya as om
+import maya.cmds as cmds
+import os.path
+
+COMMAND = "attrSnapUndoable"
+PENDING = [] # (undo, redo) waiting for the command to pick them up
+
+def maya_useNewAPI():
+    """ Plugin uses the python API 2.0 """
+
+class Undoable(om.MPxCommand):
+    """ Hold changes already made, so they can be undone and redone """
+    def __init__(s):
+        om.MPxCommand.__init__(s)
+        s.changes = []
+
+    def doIt(s, args):
+        s.changes = PENDING[:]
+        del PENDING[:]
+
+    def undoIt(s):
+        for undo, _ in reversed(s.changes):
+            undo()
+
+    def redoIt(s):
+        for _, redo in s.changes:
+            redo()
+
+    def isUndoable(s):
+        return True
+
+    @staticmethod
+    def creator():
+        return Undoable()
+
+def initializePlugin(plugin):
+    om.MFnPlugin(plugin).registerCommand(COMMAND, Undoable.creator)
+
+def uninitializePlugin(plugin):
+    om.MFnPlugin(plugin).deregisterCommand(COMMAND)
+
+def register(*changes):
+    """ Put MDGModifiers and MAnimCurveChanges, already done, onto the undo queue. In order. """
+    path = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+    if not cmds.pluginInfo(path, q=True, l=True):
+        cmds.loadPlugin(path, quiet=True)
+    for change in changes:
+        if isinstance(change, om.MDGModifier):
+            PENDING.append((change.undoIt, change.doIt))
+        else:
+            PENDING.append((change.undoIt, change.redoIt))
+    getattr(cmds, COMMAND)()
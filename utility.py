@@ -15,4 +15,7 @@
 try:
     from utility_maya import *
 except ImportError:
-    raise RuntimeError("No such utility class")
+    try:
+        from utility_headless import *
+    except ImportError:
+        raise RuntimeError("No such utility class")
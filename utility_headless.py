@@ -0,0 +1,135 @@
+# Utilize some functionalities without a host application
+# Created By Jason Dixon. http://internetimagery.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is a labor of love, and therefore is distributed
+# in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+from __future__ import print_function
+from element_headless import SCENE, ALIASES, COMPONENT, inverse_matrix, mult_matrix, decompose_rotation, get_upstream, get_node_id
+import contextlib
+import warnings
+import events
+
+def warn(message, popup=False):
+    """ Provide a warning """
+    warnings.warn(message)
+
+def get_frame():
+    """ Get current frame """
+    return SCENE.time
+
+def set_frame(f):
+    """ Move to frame """
+    SCENE.set_time(f)
+
+IDLE = [] # Functions for the host loop to run with run_idle
+
+def add_idle(func):
+    """ Run func whenever the host is idle. Returns handle for remove_idle. """
+    IDLE.append(func)
+    return func
+
+def remove_idle(handle):
+    """ Stop running function added with add_idle """
+    if handle in IDLE:
+        IDLE.remove(handle)
+
+def run_idle():
+    """ Nothing else to do. Run idle functions once. """
+    for func in list(IDLE):
+        func()
+
+def export_scene():
+    """ Scene in a form a worker process can load with import_scene """
+    return SCENE.dump()
+
+def import_scene(scene):
+    """ Load scene from export_scene """
+    SCENE.restore(scene)
+
+def get_influences(attributes, markers):
+    """ Which markers each attribute could move, through parenting. {attribute: set(markers)} """
+    upstream = {a: get_upstream(a) for a in markers}
+    return {a: set(b for b in markers if get_node_id(a) in upstream[b]) for a in attributes}
+
+def valid_object(obj):
+    """ Check object is valid and exists """
+    component = COMPONENT.match(obj)
+    if component is not None:
+        return SCENE.exists(component.group(1)) and bool(SCENE.get(component.group(1)).points)
+    return SCENE.exists(obj)
+
+def valid_attribute(attr):
+    """ Check attribute is valid and exists """
+    obj, _, at = attr.rpartition(".")
+    return SCENE.exists(obj) and ALIASES.get(at, at) in SCENE.get(obj).attrs
+
+def attribute_range(attr):
+    """ Return attribute range. None = infinite """
+    return [None, None]
+
+def get_playback_range():
+    """ Get frame range from playback """
+    return SCENE.time, SCENE.time
+
+def frame_walk(start, end):
+    """ Move along frames """
+    origin = SCENE.time
+    for frame in range(int(start), int(end + 1)):
+        SCENE.set_time(frame)
+        yield frame
+    SCENE.set_time(origin)
+
+def local_values(obj, matrix):
+    """ Translate / Rotate values placing object at world matrix """
+    node = SCENE.get(obj)
+    if node.parent is not None:
+        matrix = mult_matrix(matrix, inverse_matrix(node.parent.world_matrix()))
+    values = dict(zip(("tx", "ty", "tz"), matrix[12:15]))
+    values.update(zip(("rx", "ry", "rz"), decompose_rotation(matrix)))
+    return values
+
+def hacky_snap(grp):
+    """ Quick and dirty hack. Move directly to marker location test. """
+    attrs = [a+b for a in "tr" for b in "xyz"]
+    parts = [a for a in grp if a.attr in attrs]
+    if not parts: return False # We don't have any attributes to snap
+
+    # Collect information
+    original_snapshot = old_snapshot = grp.get_snapshot()
+    try:
+        for marker in (b for a in grp.markers for b in a):
+            # Snap objects to markers
+            matrix = marker.get_matrix()
+            values = {}
+            for attr in parts:
+                if attr.obj not in values:
+                    values[attr.obj] = local_values(attr.obj, matrix)
+                attr.set_value(values[attr.obj][attr.attr])
+            new_snapshot = grp.get_snapshot()
+            if new_snapshot.dist < old_snapshot.dist: old_snapshot = new_snapshot
+    finally:
+        grp.set_values(old_snapshot.vals) # Reset values
+        grp.clear_cache() # Clean up cache, because we've messed with things manually
+    return old_snapshot.dist < original_snapshot.dist
+
+@contextlib.contextmanager
+def progress(rate=1):
+    """ Run operations, printing progress along the way. "rate" times a second at most. """
+
+    def update(val):
+        """ Update progress. Expect value 0 ~ 1 """
+        print("Matching ... {:.0%}".format(val))
+
+    try:
+        yield events.Throttle(update, rate)
+    except KeyboardInterrupt:
+        pass
@@ -17,6 +17,8 @@ import maya.cmds as cmds
 import maya.mel as mel
 import contextlib
 import difflib
+import element
+import events
 import groups
 import re
 
@@ -54,6 +56,31 @@ def set_frame(f):
     """ Move to frame """
     cmds.currentTime(f)
 
+def add_idle(func):
+    """ Run func whenever maya is idle. Returns handle for remove_idle. """
+    return cmds.scriptJob(ie=func)
+
+def remove_idle(handle):
+    """ Stop running function added with add_idle """
+    if cmds.scriptJob(ex=handle):
+        cmds.scriptJob(kill=handle, force=True)
+
+def export_scene():
+    """ Scene in a form a worker process can load with import_scene """
+    path = cmds.file(q=True, sn=True)
+    if not path or cmds.file(q=True, modified=True):
+        raise RuntimeError("Please save the scene first. Workers load it from disk.")
+    return path
+
+def import_scene(scene):
+    """ Load scene from export_scene """
+    cmds.file(scene, open=True, force=True)
+
+def get_influences(attributes, markers):
+    """ Which markers each attribute could move, through parenting and connections. {attribute: set(markers)} """
+    upstream = {a: element.get_upstream(a) for a in markers}
+    return {a: set(b for b in markers if element.get_node_id(a) in upstream[b]) for a in attributes}
+
 def get_selection(num=0):
     """ Get current selection. num = expected selection number """
     sel = cmds.ls(sl=True) or []
@@ -71,13 +98,7 @@ def get_attribute():
 
 def get_matrix(obj):
     """ Get matrix in worldspace (specifically to work with faces/vertex etc) """
-    mtx = cmds.xform(obj, q=True, ws=True, m=True)
-    pos = list(zip(*[iter(cmds.xform(obj, q=True, t=True, ws=True))]*3))
-    pos_num = len(pos)
-    total = reduce(lambda x, y: (a+b for a,b in zip(x, y)) ,pos)
-    for i, val in enumerate(a/pos_num for a in total):
-        mtx[i+12] = val
-    return mtx
+    return list(element.get_marker(str(obj)).get_matrix().asMatrix())
 
 def valid_object(obj):
     """ Check object is valid and exists """
@@ -152,8 +173,8 @@ def hacky_snap(grp):
     return old_snapshot.dist < original_snapshot.dist
 
 @contextlib.contextmanager
-def progress():
-    """ Safely run operations in the scene. Clean up afterwards if errors occurr """
+def progress(rate=10):
+    """ Safely run operations in the scene. Clean up afterwards if errors occurr. Progress bar updates "rate" times a second at most. """
 
     def update(val):
         """ Update progress. Expect value 0 ~ 1 """
@@ -174,7 +195,7 @@ def progress():
     				status='Matching ...',
     				maxValue=100 )
     try:
-        yield update
+        yield events.Throttle(update, rate)
     except KeyboardInterrupt:
         pass
     except Exception as err: